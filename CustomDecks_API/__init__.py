@@ -1,55 +1,34 @@
-import requests
 import logging
-import os
-import sys
-import netCDF4 as nc
-import pandas as pd
-import numpy as np
 import azure.functions as func
-from azure.storage.blob import BlobServiceClient
-from datetime import datetime, timedelta
-from sqlalchemy import create_engine
-import pyodbc
-from get_secret import get_secret
-from azure.identity import ClientSecretCredential
-from azure.mgmt.storage import StorageManagementClient 
-from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
+import http_client
+from dls import store_in_dls
+from key_vault import get_secret, prefetch_secrets
+from lazy_import import lazy_import
 from io import StringIO
 import re 
- 
-# Define your Azure AD credentials
-tenant_id = os.getenv('AR_TENANT_ID')
-client_id = os.getenv('AR_CLIENT_ID')
-client_secret = os.getenv('AR_APP_SECRET')
-# subscription_id = '37e012c1-8275-4327-9d0f-cfae380fe36d'
-
-# Authenticate using the service principal
-credential = ClientSecretCredential(tenant_id, client_id, client_secret)
 
-key_vault_url = 'https://kv-cd-databrein-d1.vault.azure.net/'
-client = SecretClient(vault_url=key_vault_url, credential=credential)
-
-# Function to retrieve secret from Key Vault
-def get_secret(secret_name):
-    secret = client.get_secret(secret_name)
-    return secret.value
+pd = lazy_import('pandas')
+ 
+# Secrets used by this function, read together on the first request
+SECRETS = ('dls-databrein-d1-v2', 'CD-API-POST-Key')
 
 # Azure Data Lake Storage settings
 account_name = 'dlscddatabreind1'
-account_key = get_secret('dls-databrein-d1-v2')  # GET FROM KV?
 container_name = 'cd-csv-files'
 folder_name = 'CD_Backend_API'  # Specify your desired folder
-post_key = get_secret('CD-API-POST-Key')
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
+    prefetch_secrets(SECRETS)
+    account_key = get_secret('dls-databrein-d1-v2')
+    post_key = get_secret('CD-API-POST-Key')
+
     ## Call the API and retrieve data
     headers = {
         'viewcsv': post_key,
         #'Content-Type': 'application/json'
     }
     
-    response = requests.post(headers=headers, url = "https://customdecks.be/admin/plugins/besteldata_corne_rook.php?u=ernoc&p=poiuy")
+    response = http_client.post(headers=headers, url = "https://customdecks.be/admin/plugins/besteldata_corne_rook.php?u=ernoc&p=poiuy")
     data = response.text
     
     if data is not None:
@@ -107,21 +86,12 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     
 
     ## Store the csv in the dls
-    # Initialize BlobServiceClient with your Azure Storage account credentials
-    blob_service_client = BlobServiceClient(account_url=f"https://{account_name}.blob.core.windows.net",
-                                            credential=account_key)
-    logging.info('Initialized BlobServiceClient')
-
-    # Get a BlobClient for your Data Lake Storage folder
-    blob_client = blob_service_client.get_blob_client(container=container_name,
-                                                      blob=f"{folder_name}/{csv_filename}")
-
     # Setup IO string to prevent local storage
     csv_buffer = StringIO()
     df.to_csv(csv_buffer, index = False, sep = ';')
     csv_data = csv_buffer.getvalue()
 
-    blob_client.upload_blob(csv_data, overwrite = True)
+    store_in_dls(account_name, account_key, container_name, folder_name, csv_filename, csv_data)
 
     # Create the csv file # Uncomment this when using the "with open() lines
     # df.to_csv(csv_filename, index=False, sep = ';')
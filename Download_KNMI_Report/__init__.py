@@ -1,56 +1,56 @@
 # VOEG AZ en SQL connecties toe
 
-import requests
 import logging
+import multiprocessing
 import os
-import sys
 import tempfile
-import netCDF4 as nc
-import pandas as pd
-import time
 import azure.functions as func
-from azure.storage.blob import BlobServiceClient
-from datetime import datetime, timedelta
-from sqlalchemy import create_engine
-from azure.identity import ClientSecretCredential
+import http_client
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dls import get_blob_client, get_container_client, store_in_dls, download_from_dls, delete_many_in_dls
+from datetime import datetime, timezone
 from io import StringIO, BytesIO
-import pyodbc
-from azure.keyvault.secrets import SecretClient
+from key_vault import get_secret, prefetch_secrets
 import urllib
+import json
+import uuid
+from knmi import OpenDataAPI, open_dataset, iter_normalized_chunks, normalize_file, read_parquet_chunks, parse_list_param, \
+    parquet_partitions, partition_value, station_number, DE_BILT_CODE, MEMORY_BUDGET
+from lazy_import import lazy_import
 
+pd = lazy_import('pandas')
 
-# Define your Azure AD credentials
-tenant_id = os.getenv('AR_TENANT_ID')
-client_id = os.getenv('AR_CLIENT_ID')
-client_secret = os.getenv('AR_APP_SECRET')
-# subscription_id = '37e012c1-8275-4327-9d0f-cfae380fe36d'
 
-# Authenticate using the service principal
-credential = ClientSecretCredential(tenant_id, client_id, client_secret)
+# Secrets used by this function, read together on the first request
+SECRETS = ('dls-databrein-d1-v2', 'KNMI-API-Key')
+SQL_SECRETS = ('SQL-DATABASE', 'SQL-USERNAME', 'SQL-PASSWORD')
 
-key_vault_url = 'https://kv-cd-databrein-d1.vault.azure.net/'
-client = SecretClient(vault_url=key_vault_url, credential=credential)
-
-# Function to retrieve secret from Key Vault
-def get_secret(secret_name):
-    secret = client.get_secret(secret_name)
-    return secret.value
-    
 server = 'sql-cd-databrein-d1.database.windows.net'
-database = get_secret("SQL-DATABASE")
-username = get_secret("SQL-USERNAME")
-password = get_secret("SQL-PASSWORD")
 driver = 'ODBC Driver 17 for SQL Server'  # Is the driver installed?
 
-connection_string = f'mssql+pyodbc:///?odbc_connect=' + urllib.parse.quote_plus(
-    f'DRIVER={{{driver}}};'
-    f'SERVER={server};'
-    f'DATABASE={database};'
-    f'UID={username};'
-    f'PWD={password}'
-)
+# Created on the first SQL write, so requests without the sql output never touch the database secrets
+_engine = None
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        from sqlalchemy import create_engine
+
+        database = get_secret("SQL-DATABASE")
+        username = get_secret("SQL-USERNAME")
+        password = get_secret("SQL-PASSWORD")
+
+        connection_string = f'mssql+pyodbc:///?odbc_connect=' + urllib.parse.quote_plus(
+            f'DRIVER={{{driver}}};'
+            f'SERVER={server};'
+            f'DATABASE={database};'
+            f'UID={username};'
+            f'PWD={password}'
+        )
+        _engine = create_engine(connection_string)
+    return _engine
 
-engine = create_engine(connection_string)
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -59,29 +59,37 @@ logger.setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
 latest_file = 'KIS___OPER_P___OBS_____L2.nc'
 file_name = latest_file
 
-class OpenDataAPI:
-    def __init__(self, api_token: str):
-        self.base_url = "https://api.dataplatform.knmi.nl/open-data/v1"
-        self.headers = {"Authorization": api_token}
+# Streaming transfer settings: size of each staged block and how many blocks may be uploading at once.
+# Peak memory of a streamed transfer is roughly STREAM_CHUNK_SIZE * (STREAM_MAX_IN_FLIGHT + 1).
+STREAM_CHUNK_SIZE = int(os.environ.get("KNMI_STREAM_CHUNK_SIZE", 8 * 1024 * 1024))
+STREAM_MAX_IN_FLIGHT = int(os.environ.get("KNMI_STREAM_MAX_IN_FLIGHT", 4))
 
-    def __get_data(self, url, params=None):
-        return requests.get(url, headers=self.headers, params=params).json()
+# Backfill settings: page size of list_files (the API maximum), concurrent downloads and parser processes
+LIST_FILES_PAGE_SIZE = 1000
+BACKFILL_MAX_DOWNLOADS = int(os.environ.get("KNMI_BACKFILL_MAX_DOWNLOADS", 8))
+BACKFILL_MAX_PROCESSES = int(os.environ.get("KNMI_BACKFILL_MAX_PROCESSES", os.cpu_count() or 1))
 
-    def list_files(self, dataset_name: str, dataset_version: str, params: dict):
-        return self.__get_data(
-            f"{self.base_url}/datasets/{dataset_name}/versions/{dataset_version}/files",
-            params=params,
-        )
+DAILY_DATASET_NAME = "etmaalgegevensKNMIstations"
 
-    def get_file_url(self, dataset_name: str, dataset_version: str, file_name: str):
-        return self.__get_data(
-            f"{self.base_url}/datasets/{dataset_name}/versions/{dataset_version}/files/{file_name}/url"
-        )
+# Manifest of the ingested files, and the name of the CSV and Parquet outputs of the default selection,
+# other selections get their own outputs
+MANIFEST_FILENAME = 'KNMI_manifest.json'
+OUTPUT_NAME = 'KNMI_Data_Daily'
+# Largest block of an append blob
+APPEND_BLOCK_SIZE = 4 * 1024 * 1024
+
+# SQL sink: target table, prefix of the per-run staging tables used for the bulk load and rows per executemany batch
+SQL_TABLE = 'KNMI-MeteoDaily'
+SQL_STAGING_TABLE = 'KNMI-MeteoDaily_staging'
+SQL_BATCH_SIZE = int(os.environ.get("KNMI_SQL_BATCH_SIZE", 10000))
 
+# Parquet compaction: part files a partition collects before they are merged into one, and partitions merged at once
+PARQUET_COMPACT_MIN_PARTS = int(os.environ.get("KNMI_PARQUET_COMPACT_MIN_PARTS", 30))
+PARQUET_MAX_CONCURRENT = 8
 
 def download_file_from_temporary_download_url(download_url, filename):
     try:
-        with requests.get(download_url, stream=True) as r:
+        with http_client.get(download_url, stream=True) as r:
             r.raise_for_status()
             nc_file_buffer = BytesIO()
             for chunk in r.iter_content(chunk_size=8192):
@@ -90,55 +98,610 @@ def download_file_from_temporary_download_url(download_url, filename):
             return nc_file_buffer
     except Exception:
         logger.exception("Unable to download file using download URL")
-        sys.exit(1)
+        raise
 
     logger.info(f"Successfully downloaded dataset file to {filename}")
 
 
+def stream_file_to_dls(download_url, account_name, account_key, container_name, folder_name, file_name,
+                       chunk_size=STREAM_CHUNK_SIZE, max_in_flight=STREAM_MAX_IN_FLIGHT, sink=None):
+    """Pipe the HTTP response body into staged block uploads as it arrives.
+
+    Every chunk of the response becomes one staged block, uploaded by a small thread pool while the
+    next chunk is being downloaded. At most ``max_in_flight`` blocks are held in memory at once, so
+    peak memory stays flat however big the file is. The block list is committed once the download
+    has finished, which makes the blob appear atomically.
+
+    If ``sink`` is given, every chunk is also written to it, so the caller keeps a local copy of the
+    file without downloading it a second time.
+    """
+    blob_client = get_blob_client(account_name, account_key, container_name, f"{folder_name}/{file_name}")
+
+    block_ids = []
+    in_flight = set()
+    total_bytes = 0
+    try:
+        with http_client.get(download_url, stream=True) as r, \
+                ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if not chunk:
+                    continue
+                # Block ids must all have the same length within a blob
+                block_id = f"{len(block_ids):08d}"
+                block_ids.append(block_id)
+                total_bytes += len(chunk)
+                if sink is not None:
+                    sink.write(chunk)
+
+                # Wait for a free upload slot before reading further, which bounds memory use
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                in_flight.add(executor.submit(blob_client.stage_block, block_id=block_id, data=chunk))
+
+            for future in wait(in_flight).done:
+                future.result()
+
+        blob_client.commit_block_list(block_ids)
+    except Exception:
+        logger.exception("Unable to stream file from download URL to the data lake storage")
+        raise
+
+    logger.info(f"Streamed {total_bytes} bytes in {len(block_ids)} blocks to {container_name}/{folder_name}/{file_name}")
+    return total_bytes
+
+
+def download_file_to_temp(download_url):
+    """Stream a download into a local temporary file and return its path, a failed download leaves no file."""
+    with http_client.get(download_url, stream=True) as r:
+        r.raise_for_status()
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".nc") as temp_file:
+            try:
+                for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    temp_file.write(chunk)
+            except Exception:
+                temp_file.close()
+                os.remove(temp_file.name)
+                raise
+    return temp_file.name
+
+
+def backfill(api, dataset_name, dataset_version, begin, end, stations=None, variables=None,
+             max_downloads=BACKFILL_MAX_DOWNLOADS, max_processes=BACKFILL_MAX_PROCESSES, memory_budget=MEMORY_BUDGET):
+    """Download and normalize every file created between ``begin`` and ``end``, yielding the frames of each file.
+
+    The listing is paged with its continuation token. Files are downloaded to local temporary
+    files by a bounded thread pool, and each downloaded file is normalized in a separate process
+    into a local Parquet file, in time windows that fit its share of ``memory_budget``, so parsing
+    scales with the cores of the worker while the next downloads are running. The windows are read
+    back one at a time and yielded in the order of the listing, and only ``max_downloads + max_processes``
+    files are between download and yield at any time, so memory grows neither with the length of
+    the range nor with the size of a file.
+    """
+    params = {"maxKeys": LIST_FILES_PAGE_SIZE, "orderBy": "created", "sorting": "asc",
+              "begin": begin, "end": end}
+    filenames = [file_info["filename"] for file_info in api.iter_files(dataset_name, dataset_version, params)]
+    logger.info(f"Backfilling {len(filenames)} files of {dataset_name} version {dataset_version}")
+
+    def fetch(filename):
+        response = api.get_file_url(dataset_name, dataset_version, filename)
+        return download_file_to_temp(response["temporaryDownloadUrl"])
+
+    daily = dataset_name == DAILY_DATASET_NAME
+    window = max_downloads + max_processes
+    worker_budget = memory_budget // max_processes
+    # Futures by position in the listing, the Parquet files of parsed files wait in ``parsed`` until it is their turn
+    download_futures = {}
+    parse_futures = {}
+    parsed = {}
+    paths = {}
+    submitted = 0
+    yielded = 0
+    try:
+        # Forking the multi-threaded worker could copy locks held by the download threads, the parsers are spawned
+        with ThreadPoolExecutor(max_workers=max_downloads) as downloads, \
+                ProcessPoolExecutor(max_workers=max_processes, mp_context=multiprocessing.get_context('spawn')) as parsers:
+            try:
+                while yielded < len(filenames):
+                    while submitted < len(filenames) and submitted - yielded < window:
+                        download_futures[downloads.submit(fetch, filenames[submitted])] = submitted
+                        submitted += 1
+
+                    done, _ = wait(list(download_futures) + list(parse_futures), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future in download_futures:
+                            position = download_futures.pop(future)
+                            paths[position] = future.result()
+                            parse_futures[parsers.submit(normalize_file, paths[position], stations, variables, daily,
+                                                         worker_budget)] = position
+                        else:
+                            position = parse_futures.pop(future)
+                            try:
+                                parsed[position] = future.result()
+                            finally:
+                                os.remove(paths.pop(position))
+
+                    while yielded in parsed:
+                        if parsed[yielded] is not None:
+                            yield from read_parquet_chunks(parsed[yielded])
+                            os.remove(parsed[yielded])
+                        del parsed[yielded]
+                        yielded += 1
+            finally:
+                # After a failure the downloads and parses that have not started are dropped
+                for future in list(download_futures) + list(parse_futures):
+                    future.cancel()
+    finally:
+        # Every downloaded and parsed file is removed, also the ones that finished after a failure
+        for futures, results in ((download_futures, paths), (parse_futures, parsed)):
+            for future, position in futures.items():
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    results[position] = future.result()
+        for path in list(paths.values()) + list(parsed.values()):
+            if path is not None:
+                os.remove(path)
+
+
+def new_part_name():
+    return f"part-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+
+
+def append_to_blob(blob_client, text):
+    """Append text to an append blob, split into blocks that stay under the 4 MiB block limit."""
+    data = text.encode('utf-8')
+    for start in range(0, len(data), APPEND_BLOCK_SIZE):
+        blob_client.append_block(data[start:start + APPEND_BLOCK_SIZE])
+
+
+def store_parquet_in_dls(df, account_name, account_key, container_name, folder_name, replace_stations=(), part_name=None):
+    """Write the frame as compressed Parquet, partitioned by station and year, under ``folder_name``.
+
+    New data is added as new part files in the affected partitions. The partitions of the stations in
+    ``replace_stations`` are deleted first, which is needed when their history is rebuilt, the other
+    stations keep their partitions. Returns the partition folders that were written.
+    """
+    container_client = get_container_client(account_name, account_key, container_name)
+
+    if replace_stations:
+        existing = [blob.name for station in replace_stations
+                    for blob in container_client.list_blobs(name_starts_with=f"{folder_name}/Station={partition_value(station)}/")]
+        delete_many_in_dls(account_name, account_key, container_name, existing)
+
+    part_name = part_name or new_part_name()
+    partitions = []
+    for partition_path, data in parquet_partitions(df, part_name):
+        container_client.upload_blob(f"{folder_name}/{partition_path}", data, overwrite=True)
+        partitions.append(f"{folder_name}/{partition_path.rsplit('/', 1)[0]}")
+
+    logger.info(f"{len(df)} rows were written to {len(partitions)} Parquet partitions in {container_name}/{folder_name}")
+    return partitions
+
+
+def compact_parquet(account_name, account_key, container_name, folder_name, partitions=None,
+                    min_parts=PARQUET_COMPACT_MIN_PARTS):
+    """Merge the part files of every partition that has at least ``min_parts`` of them into one part file.
+
+    Every append adds a part file to the partitions it touches, compaction keeps the number of files
+    the readers open small. ``partitions`` limits it to those partition folders, by default every
+    partition below ``folder_name`` is checked. The merged file is stored before the parts are
+    deleted, so a failed compaction never loses data; a day stored twice is kept once by the next
+    compaction. Returns the compacted partition folders.
+    """
+    container_client = get_container_client(account_name, account_key, container_name)
+
+    parts = {}
+    for prefix in [f"{partition}/" for partition in partitions] if partitions is not None else [f"{folder_name}/"]:
+        for blob in container_client.list_blobs(name_starts_with=prefix):
+            if blob.name.endswith('.parquet'):
+                parts.setdefault(blob.name.rsplit('/', 1)[0], []).append(blob.name)
+
+    def compact_partition(partition):
+        # Part names start with their creation time, so later parts win
+        names = sorted(parts[partition])
+        df = pd.concat([pd.read_parquet(BytesIO(container_client.download_blob(name).readall()), engine='pyarrow')
+                        for name in names], ignore_index=True)
+        if 'Time' in df.columns:
+            df = df.drop_duplicates(subset=['Time'], keep='last').sort_values('Time', ignore_index=True)
+        buffer = BytesIO()
+        df.to_parquet(buffer, engine='pyarrow', compression='zstd', index=False)
+        container_client.upload_blob(f"{partition}/{new_part_name()}.parquet", buffer.getvalue(), overwrite=True)
+        delete_many_in_dls(account_name, account_key, container_name, names)
+        return partition
+
+    due = sorted(partition for partition, names in parts.items() if len(names) >= min_parts)
+    with ThreadPoolExecutor(max_workers=PARQUET_MAX_CONCURRENT) as executor:
+        compacted = list(executor.map(compact_partition, due))
+    if compacted:
+        logger.info(f"Compacted {len(compacted)} Parquet partitions in {container_name}/{folder_name}")
+    return compacted
+
+
+def quote_name(name):
+    """Quote a SQL Server identifier, column names are the long names of the KNMI variables."""
+    return "[" + str(name).replace("]", "]]") + "]"
+
+
+def sql_literal(value):
+    return "N'" + str(value).replace("'", "''") + "'"
+
+
+def upsert_to_sql(df, engine, table=SQL_TABLE, staging_table=SQL_STAGING_TABLE, batch_size=SQL_BATCH_SIZE):
+    """Bulk load the frame into a staging table and MERGE it into ``table`` keyed on station and date.
+
+    The staging table is filled in batches with pyodbc ``fast_executemany``, after which one
+    set-based MERGE updates existing days and inserts new ones, so re-runs are idempotent.
+    Every call gets its own staging table, named ``staging_table`` with a random suffix, so runs
+    that overlap do not drop or fill each other's staging data.
+    Missing target columns (new variables) are added as ``FLOAT`` columns.
+    """
+    df = df.dropna(subset=['Time'])
+    value_columns = [column for column in df.columns if column not in ('Station', 'Time')]
+    target = f"dbo.{quote_name(table)}"
+    staging = f"dbo.{quote_name(f'{staging_table}_{uuid.uuid4().hex[:12]}')}"
+
+    column_definitions = ", ".join(f"{quote_name(column)} FLOAT NULL" for column in value_columns)
+    key_definitions = "[Station] NVARCHAR(10) NOT NULL, [Time] DATE NOT NULL"
+    all_columns = ", ".join(quote_name(column) for column in df.columns)
+
+    # Rows as plain Python values, NaN becomes NULL
+    rows = list(zip(
+        df['Station'].astype(str),
+        df['Time'].dt.date,
+        *[df[column].astype(object).where(df[column].notna(), None) for column in value_columns],
+    ))
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.fast_executemany = True
+
+        cursor.execute(
+            f"IF OBJECT_ID({sql_literal(target)}, N'U') IS NULL "
+            f"CREATE TABLE {target} ({key_definitions}, "
+            f"{column_definitions + ', ' if value_columns else ''}PRIMARY KEY ([Station], [Time]))"
+        )
+        for column in value_columns:
+            cursor.execute(
+                f"IF COL_LENGTH({sql_literal(target)}, {sql_literal(column)}) IS NULL "
+                f"ALTER TABLE {target} ADD {quote_name(column)} FLOAT NULL"
+            )
+
+        cursor.execute(f"CREATE TABLE {staging} ({key_definitions}{', ' + column_definitions if value_columns else ''})")
+
+        insert = f"INSERT INTO {staging} ({all_columns}) VALUES ({', '.join('?' * len(df.columns))})"
+        for start in range(0, len(rows), batch_size):
+            cursor.executemany(insert, rows[start:start + batch_size])
+
+        update = ", ".join(f"target.{quote_name(column)} = source.{quote_name(column)}" for column in value_columns)
+        cursor.execute(
+            f"MERGE {target} WITH (HOLDLOCK) AS target "
+            f"USING {staging} AS source "
+            f"ON target.[Station] = source.[Station] AND target.[Time] = source.[Time] "
+            + (f"WHEN MATCHED THEN UPDATE SET {update} " if value_columns else "")
+            + f"WHEN NOT MATCHED BY TARGET THEN INSERT ({all_columns}) "
+            f"VALUES ({', '.join('source.' + quote_name(column) for column in df.columns)});"
+        )
+        affected_rows = cursor.rowcount
+        connection.commit()
+    finally:
+        # Also after a failed load, the staging table of this call is not reused
+        try:
+            connection.rollback()
+            connection.cursor().execute(f"IF OBJECT_ID({sql_literal(staging)}, N'U') IS NOT NULL DROP TABLE {staging}")
+            connection.commit()
+        finally:
+            connection.close()
+
+    logger.info(f"{len(rows)} rows were merged into {table} ({affected_rows} rows affected)")
+    return affected_rows
+
+
+def empty_manifest():
+    return {'files': [], 'outputs': {}}
+
+
+def load_manifest(account_name, account_key, container_name, folder_name):
+    """Read the manifest of ingested KNMI files from the data lake, an empty manifest if there is none yet.
+
+    The manifest records the ``filename``, ``size`` and ``created`` timestamp of every ingested file
+    with the stations, variables and outputs (see ``output_key``) it was ingested for, and per output
+    its columns and the last ingested day per station.
+    """
+    content = download_from_dls(account_name, account_key, container_name, folder_name, MANIFEST_FILENAME)
+    if content is None:
+        return empty_manifest()
+    manifest = json.loads(content)
+    # Manifests from before the per-output state and the per-selection outputs: every output is rebuilt once
+    manifest.pop('columns', None)
+    manifest.pop('last_time', None)
+    manifest['outputs'] = {key: state for key, state in manifest.get('outputs', {}).items() if ':' in key}
+    for entry in manifest['files']:
+        entry['outputs'] = [key for key in entry.get('outputs', []) if ':' in key]
+    return manifest
+
+
+def save_manifest(account_name, account_key, container_name, folder_name, manifest):
+    store_in_dls(account_name, account_key, container_name, folder_name, MANIFEST_FILENAME,
+                 json.dumps(manifest, indent=2))
+
+
+def selection_key(stations, variables):
+    """Stations and variables of a request as they are recorded in the manifest, ``None`` variables is all."""
+    return {
+        'stations': sorted({station_number(code) for code in stations or [DE_BILT_CODE]}),
+        'variables': sorted(variables) if variables else None,
+    }
+
+
+def output_name(selection):
+    """Name of the CSV and Parquet outputs of a selection, e.g. ``KNMI_Data_Daily_240-260_TG``.
+
+    Every selection writes to its own outputs, so a request for other stations or variables never
+    replaces the history of another selection. The default selection keeps ``OUTPUT_NAME``.
+    """
+    if selection == selection_key(None, None):
+        return OUTPUT_NAME
+    name = f"{OUTPUT_NAME}_{'-'.join(selection['stations'])}"
+    if selection['variables']:
+        name += f"_{'-'.join(selection['variables'])}"
+    return name
+
+
+def output_key(output, name):
+    """Key of an output in the manifest, e.g. ``csv:KNMI_Data_Daily``."""
+    return f"{output}:{name}"
+
+
+def covers(ingested, requested):
+    """Whether an ingested list holds every requested item, ``None`` stands for everything."""
+    if ingested is None:
+        return True
+    return requested is not None and set(requested) <= set(ingested)
+
+
+def is_ingested(manifest, file_info, selection, outputs):
+    """True when a file with the same name, size and ``created`` timestamp was ingested before for the
+    requested stations and variables into every requested output."""
+    return any(entry['filename'] == file_info.get('filename')
+               and entry['size'] == file_info.get('size')
+               and entry['created'] == file_info.get('created')
+               and covers(entry.get('stations', []), selection['stations'])
+               and covers(entry.get('variables', []), selection['variables'])
+               and set(outputs) <= set(entry.get('outputs', []))
+               for entry in manifest['files'])
+
+
+def select_new_days(df, last_time):
+    """Keep only the rows that are newer than the last ingested day of their station in ``last_time``."""
+    station_last_time = pd.to_datetime(df['Station'].map(last_time))
+    return df[station_last_time.isna() | (df['Time'] > station_last_time)]
+
+
+def forget_output(manifest, key):
+    """Remove the output ``key`` from every ingested file, a rebuilt output only holds what is written after."""
+    for entry in manifest['files']:
+        entry['outputs'] = [output for output in entry.get('outputs', []) if output != key]
+    manifest['files'] = [entry for entry in manifest['files'] if entry['outputs']]
+    return manifest
+
+
+def update_manifest(manifest, file_info, selection, outputs):
+    manifest['files'].append({
+        'filename': file_info.get('filename'),
+        'size': file_info.get('size'),
+        'created': file_info.get('created'),
+        'stations': selection['stations'],
+        'variables': selection['variables'],
+        'outputs': sorted(outputs),
+        'ingested_at': datetime.now(timezone.utc).isoformat(),
+    })
+    return manifest
+
+
+def write_outputs(chunks, outputs, account_name, account_key, container_name, csv_blob_name, parquet_folder,
+                  manifest=None, incremental=False, name=OUTPUT_NAME):
+    """Write a stream of normalized frames to the CSV, Parquet and SQL outputs, one frame in memory at a time.
+
+    Every output keeps its own state in the manifest under ``output_key(output, name)``. When
+    ``incremental`` and the output was last written with the same columns as the frames, only rows
+    newer than its last ingested day per station are appended. Otherwise that output is rewritten:
+    the CSV is recreated as an append blob and the Parquet partitions of the written stations are
+    replaced, and the output is removed from the files recorded before. Parquet partitions that have
+    collected ``PARQUET_COMPACT_MIN_PARTS`` part files are compacted afterwards. The columns and last ingested day per station of the
+    outputs are updated; the caller saves the manifest. Returns the number of rows written.
+    """
+    if manifest is None:
+        manifest = empty_manifest()
+
+    csv_blob_client = get_blob_client(account_name, account_key, container_name, csv_blob_name)
+    part_prefix = new_part_name()
+    keys = {output: output_key(output, name) for output in outputs}
+
+    append = None
+    last_time = {}
+    rows_written = 0
+    # Stations whose Parquet partitions were replaced by this rebuild, and the partitions written
+    replaced = set()
+    partitions = set()
+    for i, chunk in enumerate(chunks):
+        if append is None:
+            # The first chunk decides between appending and rewriting, per output
+            columns = list(chunk.columns)
+            append = {output: incremental and manifest['outputs'].get(keys[output], {}).get('columns') == columns
+                      for output in outputs}
+            for output in outputs:
+                if not append[output]:
+                    manifest['outputs'][keys[output]] = {'columns': columns, 'last_time': {}}
+                    forget_output(manifest, keys[output])
+            if 'csv' in outputs and not append['csv']:
+                csv_blob_client.create_append_blob()
+
+        new_rows = {output: select_new_days(chunk, manifest['outputs'][keys[output]]['last_time']) if append[output] else chunk
+                    for output in outputs}
+
+        if 'csv' in outputs:
+            # Setup IO string to prevent local storage, the header goes with the first chunk of a new CSV
+            csv_buffer = StringIO()
+            new_rows['csv'].to_csv(csv_buffer, index = False, sep = ';', header = not append['csv'] and i == 0)
+            append_to_blob(csv_blob_client, csv_buffer.getvalue())
+
+        if 'parquet' in outputs and len(new_rows['parquet']):
+            # Appends only add part files for the new days, a rebuild first replaces the partitions of each station once
+            replace_stations = set() if append['parquet'] else set(new_rows['parquet']['Station']) - replaced
+            replaced |= replace_stations
+            partitions.update(store_parquet_in_dls(new_rows['parquet'], account_name, account_key, container_name,
+                                                   parquet_folder, replace_stations = sorted(replace_stations),
+                                                   part_name = f"{part_prefix}-{i:05d}"))
+
+        # Sla de gegevens op in de database, the MERGE makes re-runs idempotent
+        if 'sql' in outputs and len(new_rows['sql']):
+            upsert_to_sql(new_rows['sql'], get_engine())
+
+        chunk_last_time = chunk.dropna(subset=['Time']).groupby('Station')['Time'].max()
+        for station, last in chunk_last_time.items():
+            last_time[station] = max(last_time.get(station, last), last)
+        rows_written += max(len(rows) for rows in new_rows.values())
+
+    for output in outputs if append is not None else []:
+        manifest['outputs'][keys[output]]['last_time'].update({station: last.isoformat() for station, last in last_time.items()})
+    if partitions:
+        compact_parquet(account_name, account_key, container_name, parquet_folder, partitions=sorted(partitions))
+    logger.info(f"{rows_written} rows were written as {', '.join(outputs)}")
+    return rows_written
+
+
 def main(req: func.HttpRequest) -> func.HttpResponse:
 
+    # 'stream' pipes the download straight into the data lake, 'buffer' downloads the whole file first
+    transfer = req.params.get('transfer', 'stream')
+    if transfer not in ('stream', 'buffer'):
+        return func.HttpResponse(
+            "Invalid transfer mode. Please use 'stream' or 'buffer'.",
+            status_code=400
+        )
+
+    # Comma separated KNMI station codes and variable names, e.g. ?stations=260,240&variables=TG,RH
+    # Without stations only De Bilt is read, without variables every observation variable is read
+    stations = parse_list_param(req.params.get('stations'))
+    variables = parse_list_param(req.params.get('variables'))
+
+    # 'latest' ingests the newest file, 'backfill' loads every file created between ?begin= and ?end= (YYYY-MM-DD),
+    # 'compact' merges the Parquet part files of the selection into one file per partition
+    mode = req.params.get('mode', 'latest')
+    if mode not in ('latest', 'backfill', 'compact'):
+        return func.HttpResponse(
+            "Invalid mode. Please use 'latest', 'backfill' or 'compact'.",
+            status_code=400
+        )
+    if mode == 'backfill':
+        try:
+            begin = datetime.strptime(req.params.get('begin', ''), '%Y-%m-%d')
+            end = datetime.strptime(req.params.get('end', ''), '%Y-%m-%d')
+        except ValueError:
+            return func.HttpResponse(
+                "Please pass begin and end dates in the format YYYY-MM-DD for a backfill.",
+                status_code=400
+            )
+
+    # Comma separated outputs: 'csv', 'parquet' (partitioned by station and year) and/or 'sql' (MERGE into SQL Server)
+    outputs = parse_list_param(req.params.get('output', 'csv,parquet'))
+    if not outputs or not set(outputs) <= {'csv', 'parquet', 'sql'}:
+        return func.HttpResponse(
+            "Invalid output. Please use a comma separated list of 'csv', 'parquet' and 'sql'.",
+            status_code=400
+        )
+
+    # Incremental runs skip files that were ingested before and only append new days to the CSV,
+    # ?incremental=false rebuilds the CSV from the latest file
+    incremental = req.params.get('incremental', 'true').lower() != 'false'
+
+    prefetch_secrets(SECRETS + SQL_SECRETS if 'sql' in outputs else SECRETS)
+
     # Azure Data Lake Storage settings
     account_name = 'dlscddatabreind1'
     account_key = get_secret('dls-databrein-d1-v2') # GET FROM KV?
     container_name = 'knmi-nc-files'
     folder_name = 'KNMI - Meteo data - daily'  # Specify your desired folder
 
+    if mode == 'compact':
+        parquet_folder = f"{folder_name}/{output_name(selection_key(stations, variables))}"
+        compacted = compact_parquet(account_name, account_key, container_name, parquet_folder, min_parts=2)
+        return func.HttpResponse(f"{len(compacted)} Parquet partitions of {container_name}/{parquet_folder} were compacted")
+
     api_key = get_secret('KNMI-API-Key') # PUT THIS IN KV
-    dataset_name = "etmaalgegevensKNMIstations" #/versions/1/files Dit staat in CLASS OpenDataAPI: def get_file_url
-    dataset_version = "1"
-    logger.info(f"Fetching latest file of {dataset_name} version {dataset_version}")
+    dataset_name = req.params.get('dataset', DAILY_DATASET_NAME) #/versions/1/files Dit staat in CLASS OpenDataAPI: def get_file_url
+    dataset_version = req.params.get('version', "1")
 
     api = OpenDataAPI(api_token=api_key)
 
+    # The latest file goes into the daily CSV, Parquet folder and manifest, other datasets only have a backfill
+    if mode == 'latest' and dataset_name != DAILY_DATASET_NAME:
+        return func.HttpResponse(
+            f"Other datasets than {DAILY_DATASET_NAME} are only available with mode=backfill.",
+            status_code=400
+        )
+
+    # The SQL table holds one row per station and day
+    if 'sql' in outputs and dataset_name != DAILY_DATASET_NAME:
+        return func.HttpResponse(
+            f"The 'sql' output is only available for {DAILY_DATASET_NAME}.",
+            status_code=400
+        )
+
+    if mode == 'backfill':
+        chunks = backfill(api, dataset_name, dataset_version, begin.isoformat(), end.isoformat(), stations, variables)
+
+        # One combined output for the whole range
+        backfill_name = f"KNMI_Backfill_{dataset_name}_{begin:%Y%m%d}_{end:%Y%m%d}"
+        rows_written = write_outputs(chunks, outputs, account_name, account_key, container_name,
+                                     f"{folder_name}/{backfill_name}.csv", f"{folder_name}/{backfill_name}")
+
+        return func.HttpResponse(f"{rows_written} rows were backfilled to {container_name}/{folder_name}/{backfill_name}")
+
+    logger.info(f"Fetching latest file of {dataset_name} version {dataset_version}")
+
     # sort the files in descending order and only retrieve the first file
     params = {"maxKeys": 1, "orderBy": "created", "sorting": "desc"}
     response = api.list_files(dataset_name, dataset_version, params)
     if "error" in response:
         logger.error(f"Unable to retrieve list of files: {response['error']}")
-        sys.exit(1)
+        return func.HttpResponse(f"Unable to retrieve list of files: {response['error']}", status_code=502)
 
-    print(response)
-    latest_file = response["files"][0].get("filename")
+    latest_file_info = response["files"][0]
+    latest_file = latest_file_info.get("filename")
     logger.info(f"Latest file is: {latest_file}")
 
-    # fetch the download url and download the file
-    response = api.get_file_url(dataset_name, dataset_version, latest_file)
-    buffer = download_file_from_temporary_download_url(response["temporaryDownloadUrl"], latest_file)
+    # Nothing to download or parse when KNMI has not published anything new for the outputs of this selection
+    manifest = load_manifest(account_name, account_key, container_name, folder_name)
+    selection = selection_key(stations, variables)
+    name = output_name(selection)
+    output_keys = [output_key(output, name) for output in outputs]
+    if incremental and is_ingested(manifest, latest_file_info, selection, output_keys):
+        logger.info(f"{latest_file} was already ingested, skipping the run")
+        return func.HttpResponse(f"No new KNMI file, {latest_file} was already ingested")
 
-    def store_in_dls(account_name, account_key, folder_name, file_name, data):
-        # Initialize BlobServiceClient with your Azure Storage account credentials
-        blob_service_client = BlobServiceClient(account_url=f"https://{account_name}.blob.core.windows.net",
-                                                credential=account_key)
 
-        # Get a BlobClient for your Data Lake Storage folder
-        blob_client = blob_service_client.get_blob_client(container=container_name,
-                                                        blob=f"{folder_name}/{file_name}")
-
-        blob_client.upload_blob(data, overwrite = True)
+    # fetch the download url and download the file
+    response = api.get_file_url(dataset_name, dataset_version, latest_file)
 
-        return print(f'{file_name} was uploaded to the data lake storage')
-    
-    store_in_dls(account_name = account_name, account_key = account_key, folder_name = folder_name, file_name = latest_file, data = buffer) 
+    try:
+        if transfer == 'stream':
+            # Keep a local copy of the streamed bytes, so the dataset can be parsed without downloading it again
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".nc") as local_copy:
+                nc_source = local_copy.name
+                stream_file_to_dls(response["temporaryDownloadUrl"], account_name, account_key, container_name, folder_name, latest_file,
+                                   sink=local_copy)
+        else:
+            buffer = download_file_from_temporary_download_url(response["temporaryDownloadUrl"], latest_file)
+            store_in_dls(account_name, account_key, container_name, folder_name, latest_file, buffer)
+            # Parse straight from the downloaded buffer instead of fetching the blob back from the data lake
+            nc_source = buffer.getbuffer()
+    except Exception as e:
+        if transfer == 'stream':
+            os.remove(nc_source)
+        return func.HttpResponse(f"Failed to download {latest_file}: {e}", status_code=502)
 
     # Optionally, delete the local downloaded file
     #os.remove(latest_file)
@@ -151,185 +714,43 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     #    main()
 
 
-  # Function to flatten multi-dimensional arrays without adding dimension columns
-    def flatten_array(arr, var_name):
-        if arr.ndim == 0:  # Scalar value
-            return pd.DataFrame({var_name: [arr.item()]})
-        elif arr.ndim == 1:  # 1-dimensional array
-            return pd.DataFrame(arr, columns=[var_name])
-        else:  # Multi-dimensional array
-            return pd.DataFrame(arr.reshape(-1), columns=[var_name])
-
-    reference_date = datetime(1950, 1, 1, 0, 0, 0)
-    def convert_time_to_date(num_time, time_units):
-        # Define the reference date       
-        # Convert time based on units
-        if time_units.startswith('days since'):
-            days = num_time
-            return reference_date + timedelta(days= days - 1)
-        elif time_units.startswith('seconds since'):
-            seconds = num_time
-            return reference_date + timedelta(seconds=seconds)
-        else:
-            raise ValueError("Unsupported time units. Supported units are 'days since' or 'seconds since'.")
-
-    
-    def access_file_from_adls(account_name, account_key, container_name, folder_name, file_name):
-        try:
-            # Initialize BlobServiceClient with your Azure Storage account credentials
-            logging.info("Initializing BlobServiceClient.")
-            blob_service_client = BlobServiceClient(account_url=f"https://{account_name}.blob.core.windows.net",
-                                                    credential=account_key)
-
-            # Get a BlobClient for your Data Lake Storage file
-            logging.info("Getting BlobClient for the file.")
-            blob_client = blob_service_client.get_blob_client(container=container_name,
-                                                            blob=f"{folder_name}/{file_name}")
-
-            # Check if the blob exists
-            logging.info("Checking if blob exists.")
-            if not blob_client.exists():
-                logging.error(f"Blob {file_name} does not exist in the container {container_name}.")
-                return None
-
-            # Download the file content as bytes
-            logging.info("Downloading blob content.")
-            download_stream = blob_client.download_blob()
-
-            # Read the content in chunks
-            file_content = bytearray()
-            for chunk in download_stream.chunks():
-                file_content.extend(chunk)
-
-            if not file_content:
-                logging.error("Failed to download blob content or content is empty.")
-                return None
-
-            # Save the content to a temporary file
-            logging.info("Writing content to a temporary file.")
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".nc") as temp_file:
-                temp_file.write(file_content)
-                temp_file_path = temp_file.name
-                logging.info(f"Temporary file created at {temp_file_path}")
-
-            return temp_file_path
-
-        except Exception as e:
-            logging.error(f"Failed to read the NetCDF file: {e}")
-            return None
-    
-            
-
-    def create_normalized_df(file):  
-        try:
-            # Verify that the file exists and is not empty
-            logging.info(f"Opening NetCDF file: {file}")
-            with open(file, 'rb') as f:
-                content = f.read()
-                if not content:
-                    logging.error("NetCDF file is empty.")
-                    return None
-
-            # Open the dataset
-            with nc.Dataset(file, 'r') as dataset:
-                # Log the dataset details
-                logging.info(f"NetCDF Dataset details: {dataset}")
-                logging.info(f"Dataset dimensions: {dataset.dimensions}")
-                logging.info(f"Dataset variables: {dataset.variables}")
-
-                # Check if 'time' variable exists
-                if 'time' not in dataset.variables:
-                    logging.error("'time' variable not found in the NetCDF dataset.")
-                    return None
-
-                # Access the 'time' variable
-                time_var = dataset.variables['time']
-                logging.info(f"Time variable details: {time_var}")
-
-                # Access the time values
-                time_values = time_var[:]
-                time_units = time_var.units
-
-                # Extract the dimensions
-                stations = dataset.variables['station'][:]
-                days = [convert_time_to_date(time_val, time_units) for time_val in time_values]
-
-                times = []
-                for t in days:
-                    if isinstance(t, float) and t >= 9.969209968386869e+35:
-                        times.append(np.nan)  # Replace _FillValue with NaN or handle appropriately
-                    else:
-                        times.append(t) # t is already the reference time + presented time.
-
-                excluded_vars = {'station', 'time', 'lat', 'lon', 'iso_dataset', 'product', 'projection'}
-                variable_names = [var for var in dataset.variables.keys() if var not in excluded_vars]
-
-                variables = {var_name: dataset.variables[var_name][:] for var_name in variable_names}
-                long_names = {var_name: dataset.variables[var_name].long_name for var_name in variable_names}
-
-                # Prepare the data for the DataFrame
-                data = []
-        
-                #for i, station in enumerate(stations):
-                for j, time in enumerate(times):
-                    row = {
-                        'Station': '260',
-                        'Time': time,
-                    }
-                    for var_name in variable_names:
-                        row[long_names[var_name]] = variables[var_name][18, j] # index 18 is the bilt
-                    data.append(row)
-
-                # Create the DataFrame
-                df = pd.DataFrame(data)
-                df['Time'] = df['Time'] - pd.Timedelta(days=1)
-
-            return df
-        
-        except Exception as e:
-            logging.error(f"Failed to process the NetCDF file: {e}")
-            return None
-    
-    
-    file_content = access_file_from_adls(account_name, account_key, container_name, folder_name, latest_file)
-    #if file_content is not None:
-    #    logger.info(f"{file_name} was accessed and read")
-    #    logger.info(f"The type is {type(file_content)}")
-    #    logger.info(f"The path is {file_content }")
-    #else:
-    #    logger.error(f"Failed to access or read {file_name}")
-    
-    
-    if file_content:
-        logger.info(f"{latest_file} was accessed and downloaded to {file_content}")
-        df = create_normalized_df(file_content)
-        if df is not None:
-            logger.info("DataFrame created successfully.")
-            logger.info(df.head())
-        else:
-            logger.error("Failed to create DataFrame.")
-        # Clean up the temporary file after processing
-        os.remove(file_content)
+    if transfer == 'stream':
+        is_empty = os.path.getsize(nc_source) == 0
     else:
-        logger.error(f"Failed to access or download {latest_file}")
-
-    
-    csv_filename = 'KNMI_Data_Daily.csv'
-
-    # Setup IO string to prevent local storage
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer, index = False, sep = ';')
-    csv_data = csv_buffer.getvalue()
-    
-    store_in_dls(account_name = account_name, account_key = account_key, folder_name = folder_name, file_name = csv_filename, data = csv_data)
-    
-    # Sla de gegevens op in de database
-    
-    #logging.info(database)
-    #logging.info(username)
-    #affected_rows = filtered_df.to_sql("KNMI-MeteoDaily", engine, if_exists='append', index=False)
-        
-    #logger.info(f'Upload gedaan')
-    # engine.dispose()
-  
-    return func.HttpResponse(f"Files {latest_file} and {csv_filename} were uploaded successfully to {container_name}/{folder_name}")
+        is_empty = len(nc_source) == 0
+
+    try:
+        if is_empty:
+            logger.error(f"NetCDF file {latest_file} is empty.")
+            return func.HttpResponse(f"NetCDF file {latest_file} is empty", status_code=500)
+
+        # Open the dataset from the local copy or from memory
+        logging.info("Opening NetCDF dataset.")
+        with open_dataset(nc_source) as dataset:
+            # Log the dataset details
+            logging.info(f"Dataset dimensions: {dataset.dimensions}")
+            logging.info(f"Dataset variables: {list(dataset.variables)}")
+
+            # Read only the requested stations and variables, in time windows that fit the memory budget
+            try:
+                chunks = iter_normalized_chunks(dataset, stations, variables)
+            except KeyError as e:
+                # Unknown station or variable requested, reported back to the caller
+                return func.HttpResponse(e.args[0], status_code=400)
+
+            rows_written = write_outputs(chunks, outputs, account_name, account_key, container_name,
+                                         f"{folder_name}/{name}.csv", f"{folder_name}/{name}",
+                                         manifest=manifest, incremental=incremental, name=name)
+    except Exception as e:
+        logging.error(f"Failed to process the NetCDF file: {e}")
+        return func.HttpResponse(f"Failed to process {latest_file}: {e}", status_code=500)
+    finally:
+        # Clean up the local copy after processing
+        if transfer == 'stream':
+            os.remove(nc_source)
+
+    # Only record the file once every output has been written
+    save_manifest(account_name, account_key, container_name, folder_name,
+                  update_manifest(manifest, latest_file_info, selection, output_keys))
+
+    return func.HttpResponse(f"{latest_file} was ingested and {rows_written} rows were written as {', '.join(outputs)} to {container_name}/{folder_name}")
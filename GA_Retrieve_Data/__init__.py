@@ -1,40 +1,30 @@
-import os
-import pandas as pd
 import azure.functions as func
 import json
 import logging
-from azure.storage.blob import BlobServiceClient
-from azure.identity import ClientSecretCredential
-from google.oauth2 import service_account
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
-from google.analytics.data_v1beta.types import (
-    DateRange,
-    Dimension,
-    Metric,
-    RunReportRequest,
-)
+from dls import store_in_dls
+from key_vault import get_secret, prefetch_secrets
+from lazy_import import lazy_import
 from io import StringIO
-from azure.keyvault.secrets import SecretClient
 
-# Define your Azure AD credentials
-tenant_id = os.getenv('AR_TENANT_ID')
-client_id = os.getenv('AR_CLIENT_ID')
-client_secret = os.getenv('AR_APP_SECRET')
+pd = lazy_import('pandas')
 
-# Authenticate using the service principal
-credential = ClientSecretCredential(tenant_id, client_id, client_secret)
-
-key_vault_url = 'https://kv-cd-databrein-d1.vault.azure.net/'
-client = SecretClient(vault_url=key_vault_url, credential=credential)
-
-# Function to retrieve secret from Key Vault
-def get_secret(secret_name):
-    secret = client.get_secret(secret_name)
-    return secret.value
+# Secrets used by this function, read together on the first request
+SECRETS = ('dls-databrein-d1-v2', 'GA-PropertyID', 'GA-JSON')
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
-    
+    # The Google clients are only needed here and take long to import, so they load with the first request
+    from google.oauth2 import service_account
+    from google.analytics.data_v1beta import BetaAnalyticsDataClient
+    from google.analytics.data_v1beta.types import (
+        DateRange,
+        Dimension,
+        Metric,
+        RunReportRequest,
+    )
+
+    prefetch_secrets(SECRETS)
+
     # Specify storage specifics
     account_name = 'dlscddatabreind1'
     account_key = get_secret('dls-databrein-d1-v2') # GET FROM KV?
@@ -52,19 +42,6 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     client = BetaAnalyticsDataClient(credentials = ga_credentials)
     logging.info('Client was set up with credentials')
     
-    # function to store files as blobs in the dls
-    def store_in_dls(account_name, account_key, folder_name, file_name, data):
-      # Initialize BlobServiceClient with your Azure Storage account credentials
-      blob_service_client = BlobServiceClient(account_url=f"https://{account_name}.blob.core.windows.net",
-                                            credential=account_key)
-    
-      # Get a BlobClient for your Data Lake Storage folder
-      blob_client = blob_service_client.get_blob_client(container=container_name,
-                                                    blob=f"{folder_name}/{file_name}")
-    
-      blob_client.upload_blob(data, overwrite = True)
-
-
     # Runs a report of active users grouped by three dimensions.
     request = RunReportRequest(
         property=f"properties/{property_id}",
@@ -118,7 +95,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     csv_data = csv_buffer.getvalue()
     logging.info(f'{csv_filename} was converted to io object')
     
-    store_in_dls(account_name = account_name, account_key = account_key, folder_name = folder_name, file_name = csv_filename, data = csv_data)
+    store_in_dls(account_name, account_key, container_name, folder_name, csv_filename, csv_data)
     logging.info(f'{csv_filename} was store in the dls')
     
     return func.HttpResponse(f'{csv_filename} was uploaded to the data lake storage')
@@ -1,14 +1,15 @@
 import os
 import json
 import logging
-from azure.identity import ManagedIdentityCredential
-from azure.keyvault.secrets import SecretClient
-from google.oauth2 import service_account
-from google.auth.transport.requests import Request
 import azure.functions as func
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
+    # Loaded with the first request instead of when the worker starts
+    from azure.identity import ManagedIdentityCredential
+    from azure.keyvault.secrets import SecretClient
+    from google.oauth2 import service_account
+    from google.auth.transport.requests import Request
 
     try:
         # Get Key Vault URL from environment variables
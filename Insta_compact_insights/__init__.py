@@ -0,0 +1,31 @@
+import logging
+import azure.functions as func
+import meta_graph
+from insights_store import compact
+from key_vault import get_secret, prefetch_secrets
+
+logger = logging.getLogger(__name__)
+
+# Azure Data Lake Storage settings
+account_name = 'dlscddatabreind1'
+container_name = 'insta-csv-files'
+
+# Secrets used by this function
+SECRETS = ('dls-databrein-d1-v2',)
+
+
+### Roll the day partitions of Insta_merge_files (mode=partitioned) into one Parquet file per month, every night
+def main(mytimer: func.TimerRequest) -> None:
+    if mytimer.past_due:
+        logger.info('The timer is past due')
+
+    prefetch_secrets(SECRETS)
+    account_key = get_secret('dls-databrein-d1-v2')
+
+    months = []
+    for folder in meta_graph.account_folders('Insta_insights'):
+        months += [f'{folder}/{month}' for month in compact(account_name, account_key, container_name, folder)]
+    if months:
+        logger.info(f"Compacted the insights of {', '.join(months)}")
+    else:
+        logger.info("No month of insights is ready to be compacted")
@@ -1,15 +1,59 @@
-import requests
 import logging
 import os
-import pandas as pd
 import azure.functions as func
+import meta_graph
 import datetime
-from azure.identity import ClientSecretCredential
-from azure.mgmt.storage import StorageManagementClient 
-from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import StringIO
-from azure.storage.blob import BlobServiceClient
+from dls import store_in_dls
+from key_vault import get_secret, prefetch_secrets
+from checkpoint import Checkpoint
+from lazy_import import lazy_import
+
+pd = lazy_import('pandas')
+
+# Secrets used by this function, read together on the first request
+SECRETS = ('dls-databrein-d1-v2',)
+
+# Time series metrics and the largest since/until range in days the API accepts for them
+VALUE_METRICS = {'follower_count': 30, 'reach': 30, 'impressions': 30}
+# follower_count is only available for the last 30 days
+VALUE_METRIC_LOOKBACK = {'follower_count': 30}
+
+# total_value metrics sum over the requested range, so they are asked for one day per request
+TOTAL_VALUE_METRICS = ['follows_and_unfollows', 'accounts_engaged', 'profile_views', 'website_clicks']
+BREAKDOWN_METRICS = {'follows_and_unfollows': 'follow_type'}
+
+# Metric/window requests that run at the same time, per account
+MAX_CONCURRENT_REQUESTS = int(os.getenv('INSTA_INSIGHTS_MAX_CONCURRENCY', 8))
+
+
+def plan_windows(since, until, window_days):
+    """Split the days ``since`` up to ``until`` (exclusive) into consecutive windows of at most ``window_days``."""
+    windows = []
+    start = since
+    while start < until:
+        end = min(start + datetime.timedelta(days = window_days), until)
+        windows.append((start, end))
+        start = end
+    return windows
+
+
+def unix_time(date):
+    return int(datetime.datetime.combine(date, datetime.time(), tzinfo = datetime.timezone.utc).timestamp())
+
+
+def task_id(task):
+    kind, metric, start, _ = task
+    return f'{kind}/{metric}/{start.isoformat()}'
+
+
+def to_json_records(records):
+    return [(date.isoformat(), name, value) for date, name, value in records]
+
+
+def from_json_records(records):
+    return [(datetime.date.fromisoformat(date), name, value) for date, name, value in records]
 
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
@@ -39,22 +83,12 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             status_code=400
         )
 
-    # Define your Azure AD credentials
-    tenant_id = os.getenv('AR_TENANT_ID')
-    client_id = os.getenv('AR_CLIENT_ID')
-    client_secret = os.getenv('AR_APP_SECRET')
-    
-    # Authenticate using the service principal
-    credential = ClientSecretCredential(tenant_id, client_id, client_secret)
-    
-    key_vault_url = 'https://kv-cd-databrein-d1.vault.azure.net/'
-    client = SecretClient(vault_url=key_vault_url, credential=credential)
-    
-    # Function to retrieve secret from Key Vault
-    def get_secret(secret_name):
-        secret = client.get_secret(secret_name)
-        return secret.value
-    
+    # Instagram accounts of this run, one or many (IG_ACCOUNTS)
+    accounts = meta_graph.instagram_accounts()
+    if not accounts:
+        return func.HttpResponse("No Instagram account is configured", status_code=500)
+    prefetch_secrets(SECRETS + tuple(secret_name for _, secret_name in accounts))
+
     # Azure Data Lake Storage settings
     account_name = 'dlscddatabreind1'
     account_key = get_secret('dls-databrein-d1-v2')  # GET FROM KV?
@@ -63,241 +97,177 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     current_date = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
     csv_filename = f'Insta_insights_{current_date}.csv'
     
-    # Get the Meta llat
-    page_access_token = get_secret('Meta-Page-Token')
-    instagram_business_account_id = os.getenv('IG_BUSINESS_ACCOUNT_ID')
-    logging.info(f'Length of the page_access_token object is {len(page_access_token)}')
-    logging.info(f'Length of the ig_business_account_id object is {len(instagram_business_account_id)}')
-    
-    url = f'https://graph.facebook.com/v20.0/{instagram_business_account_id}/insights'
-    
-    # year = 2024 # Replaced by 'since' request input parameter
-    # month = 6
-    # day = 1
-
-    def fetch_insights(url, params):
-        response = requests.get(url, params=params)
-        if response.status_code == 200:
-            logging.info('Data was fetched with status code 200')
-            return response.json()
-        else:
-            print(f"Error: {response.status_code}")
-            print(response.json())
-            logging.info('Something went wrong with accessing the API')
-            return None
-
-    # Function to process the data and add it to the DataFrame
-    def process_data(data, metric, df):
-        if 'data' in data:
-            for entry in data['data']:
+    def fetch_account_insights(instagram_business_account_id, page_access_token, budget, checkpoint):
+        url = meta_graph.graph_url(f'{instagram_business_account_id}/insights')
+        
+        # year = 2024 # Replaced by 'since' request input parameter
+        # month = 6
+        # day = 1
+
+        def fetch_insights(url, params):
+            response = meta_graph.request('GET', url, budget, params=params)
+            if response.status_code == 200:
+                logging.info('Data was fetched with status code 200')
+                return response.json()
+            else:
+                logging.warning(f"Error {response.status_code}: {response.text}")
+                logging.info('Something went wrong with accessing the API')
+                return None
+
+        # Collect the (date, metric, value) records of the values metrics, the wide frame is built once at the end
+        def process_data(data, metric):
+            records = []
+            for entry in data.get('data', []):
                 if entry['name'] == metric:
                     for value in entry['values']:
-                        date = value['end_time']
-                        # If the date is not already in the DataFrame, add it
-                        if date not in df.index:
-                            df.loc[date] = [None] * len(df.columns)
-                        df.at[date, metric] = value['value']             
-        return df
+                        records.append((pd.Timestamp(value['end_time']).date(), metric, value['value']))
+            return records
   
-  # Function to process the total_value metrics
-    def process_tv_data(data, params, metric):
-        # use try to deal with empty values
-        
-        date = params['until']
-        
-        try:
-            if params['breakdown'] == 'follow_type':
-                data = data['data'][0]['total_value']['breakdowns'][0]['results']
-                
-                # Initialize a dictionary to store the values
-                data_dict = {'FOLLOWER': 0, 'NON_FOLLOWER': 0}
-    
-                # Loop through the data and populate the dictionary
-                for item in data:
-                    dimension_value = item['dimension_values'][0]
-                    value = item['value']
-                    data_dict[dimension_value] = value
-                    #print(data_dict)
-                # Create a DataFrame with the date as the index
-                df = pd.DataFrame([data_dict], index=[date])
+      # Function to process the total_value metrics, one value for the day of the request
+        def process_tv_data(data, date, metric):
+            # use try to deal with empty values
+            try:
+                if metric in BREAKDOWN_METRICS:
+                    results = data['data'][0]['total_value']['breakdowns'][0]['results']
                 
-            elif params['breakdown'] == '':
-                data = data['data'][0]['total_value']['value']
-                #print(f'data is {data}')
-                df = pd.DataFrame([data], columns = [metric], index = [date])
+                    # Both follow types get a value, 0 when the breakdown has no result for it
+                    data_dict = {'FOLLOWER': 0, 'NON_FOLLOWER': 0}
+                    for item in results:
+                        data_dict[item['dimension_values'][0]] = item['value']
+                    return [(date, dimension, value) for dimension, value in data_dict.items()]
             
-        except (IndexError, KeyError) as e:
-            print(f"Data was empty. No results: {e}")
-            df = pd.DataFrame()
-            return df
+                return [(date, metric, data['data'][0]['total_value']['value'])]
             
-        return df
+            except (IndexError, KeyError) as e:
+                logging.info(f"Data was empty for {metric} on {date}. No results: {e}")
+                return []
   
-    def paging_calls(url, params, metric, df, type):
-        # Get initial data
-        data = fetch_insights(url, params)
-        print(data)
-        last_it = None
+        def fetch_window(task):
+            kind, metric, start, end = task
+            params = {
+            'metric': metric,
+            'access_token': page_access_token,
+            'period': 'day',
+            'since': unix_time(start),
+            'until': unix_time(end)
+            }
+            if kind == 'total_value':
+                params['metric_type'] = 'total_value'
+                params['breakdown'] = BREAKDOWN_METRICS.get(metric, '')
         
-        if data:
-          # Process the initial data
-          #if not any(entry['name'] == metric for entry in data.get('data', [])):
-          #    print(f"Metric {metric} not defined in the response.")
-          #    return
-            if data and type != 'total_value':
-                df = process_data(data, metric, df)
-            elif type == 'total_value':
-                df = process_tv_data(data, params, metric)
-            else:
-                return print('INVALID TYPE WAS PROVIDED')
-            
-            # Check if there's a 'previous' link in the pagination
-            while 'paging' in data and ('previous' in data['paging'] or 'next' in data['paging']):
-                if "since" in params and last_it is None:            
-    
-                    if 'next' not in data['paging']:
-                        last_it = 1
-                        print('Reached current date')
-                        break
-                    
-                    page_url = data['paging']['next']
-                    print(f"Fetching next data from: {page_url}")
-                    
-                else:
-                    page_url =  data['paging']['previous']
-                    print(f"Fetching previous data from: {page_url}")
-                
-                # Make a request to the previous URL
-                data = fetch_insights(page_url, {})
-                
-                if data and type != 'total_value':
-                    df = process_data(data, metric, df)
-                elif type == 'total_value':
-                    params['until'] = params['until'] + datetime.timedelta(days = 1)
-                    df_process = process_tv_data(data, params, metric)
-                    df = pd.concat([df, df_process], axis = 0)
-                else:
-                    print("Failed to fetch previous data.")
-                    break
-            print('broken')
-        return df
+            data = fetch_insights(url, params)
+            if not data:
+                logging.warning(f"Failed to fetch {metric} from {start} to {end}")
+                return kind, None
+            if kind == 'total_value':
+                return kind, process_tv_data(data, start, metric)
+            return kind, process_data(data, metric)
 
   
 
-  ### Start applying the function to actually retrieve and process data
+      ### Start applying the function to actually retrieve and process data
 
-  ## Start by getting the regular value metrics
-  # Initialize an empty DataFrame with date as index
-    metrics = ['follower_count', 'reach', 'impressions']
-    df = pd.DataFrame(columns=metrics)
-    df.index.name = 'date'
-  
-  # Loop through each metric and get the data
-    for metric in metrics:
-      # Construct the URL
-      url = f'https://graph.facebook.com/v20.0/{instagram_business_account_id}/insights'
-      
-      if metric == 'follower_count': # should be some except or try command? # in [special list]:?
-          
-          params = {
-          'metric': metric,
-          'access_token': page_access_token,
-          'period': 'day'
-          }
-      
-          df_paging = paging_calls(url, params, metric, df, type = 'values')
-          df = pd.concat([df, df_paging], axis = 0)
-      
-      else:
-          since = since_req
-          until = since + datetime.timedelta(days = 30)
-          
-          params = {
-          'metric': metric,
-          'access_token': page_access_token,
-          'period': 'day',
-          'since': since,
-          'until': until
-          }
-          
-          df_paging = paging_calls(url, params, metric, df, type = 'values')
-          df = pd.concat([df, df_paging], axis = 0)
-          continue               
-    logging.info('Looped through value metrics')
-  
-    # Sort the DataFrame by date
-    df.index = pd.to_datetime(df.index)
-    df.drop_duplicates(inplace=True)
-    df.sort_index(inplace=True)   
-
-    ## Get the total_value metrics
-    total_value_metrics = ['follows_and_unfollows', 'accounts_engaged', 'profile_views', 'website_clicks']
-    breakdown_metrics = ['follows_and_unfollows']
-  
-    df_tv = pd.DataFrame() # columns=total_value_metrics
-    df_tv.index.name = 'date'
-  
-    for metric in total_value_metrics:
-        since = since_req
-        until = since + datetime.timedelta(days = 0)
-            
-        if metric in breakdown_metrics:
-            breakdown = 'follow_type'
-        else:
-            breakdown = ''
-                
-        params = {
-        'metric': metric,
-        'access_token': page_access_token,
-        'period': 'day',
-        'since': since,
-        'until': until,
-        'breakdown': breakdown,
-        'metric_type': 'total_value' 
-        }
-        
-        # Ensure indexes are unique before concatenation
-        if not df.index.is_unique:
-            df = df.reset_index(drop=True)
+      ## Plan the largest windows each metric allows between since_req and today
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        since = since_req.date()
+        until = today + datetime.timedelta(days = 1)
     
-        if not df_paging.index.is_unique:
-            df_paging = df_paging.reset_index(drop=True)
-        
-        # Align indexes if necessary
-        df_paging = df_paging.reindex(df.index)
-        
-        df_paging = paging_calls(url, params, metric, df, type= 'total_value')
-        df_paging.index.name = 'date'
-        df_tv = pd.concat([df_tv, df_paging], axis = 1)
-    logging.info('Looped through total_value metrics')
-
-    df.index = df.index.date
-    df_tv.index = df_tv.index.date
-    df_insights = pd.merge(left = df, right = df_tv, left_index = True, right_index = True, how = 'right') # Used to be left, but right is convenient for incremental loads since df_tv is subjected properly to the since_req paramter
-    logging.info('merged df and df_tv')
-
-    # Remove empty rows from df_insights
-    columns_to_check = [5, 6, 7]
-    # Remove rows with empty values in specified columns
-    df_insights = df_insights.dropna(subset=df_insights.columns[columns_to_check])
-
-    # Setup IO string to prevent local storage
-    csv_buffer = StringIO()
-    df_insights.to_csv(csv_buffer, index = True, index_label = 'date', sep = ';')
-    csv_data = csv_buffer.getvalue()
-    logging.info('Set up the csv buffer')
-
-    ## Store the csv in the dls
-    # Initialize BlobServiceClient with your Azure Storage account credentials
-    blob_service_client = BlobServiceClient(account_url=f"https://{account_name}.blob.core.windows.net",
-                                            credential=account_key)
-    logging.info('Initialized BlobServiceClient')
-
-    # Get a BlobClient for your Data Lake Storage folder
-    blob_client = blob_service_client.get_blob_client(container=container_name,
-                                                        blob=f"{folder_name}/{csv_filename}")
-
-    blob_client.upload_blob(csv_data, overwrite = True)
-    logging.info('file was uploaded')
-
-    return func.HttpResponse(f'{csv_filename} was uploaded to {account_name}/{container_name}/{folder_name}')
+        tasks = []
+        for metric, window_days in VALUE_METRICS.items():
+            start = since
+            if metric in VALUE_METRIC_LOOKBACK:
+                start = max(since, today - datetime.timedelta(days = VALUE_METRIC_LOOKBACK[metric]))
+            tasks += [('values', metric, window_start, window_end) for window_start, window_end in plan_windows(start, until, window_days)]
+        for metric in TOTAL_VALUE_METRICS:
+            tasks += [('total_value', metric, window_start, window_end) for window_start, window_end in plan_windows(since, until, 1)]
+        logging.info(f'Planned {len(tasks)} requests from {since} to {today}')
+  
+      ## Continue from the checkpoint of a run that was stopped, its finished requests are not repeated
+        progress = checkpoint.load() or {'done': [], 'records': [], 'tv_records': []}
+        done = set(progress['done'])
+        records = from_json_records(progress['records'])
+        tv_records = from_json_records(progress['tv_records'])
+        pending = [task for task in tasks if task_id(task) not in done]
+        logging.info(f'{len(tasks) - len(pending)} requests were done by an earlier run')
+
+        def save_progress(force = False):
+            checkpoint.save({'done': sorted(done), 'records': to_json_records(records),
+                             'tv_records': to_json_records(tv_records)}, force = force)
+
+      ## Run all metric/window requests concurrently, the records are merged by date in the pivot below
+        error = None
+        failed = []
+        with ThreadPoolExecutor(max_workers = MAX_CONCURRENT_REQUESTS) as executor:
+            futures = {executor.submit(fetch_window, task): task for task in pending}
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                try:
+                    kind, window_records = future.result()
+                except Exception as e:
+                    # Requests that have not started are dropped, the finished ones still go into the checkpoint
+                    error = error or e
+                    for other in futures:
+                        other.cancel()
+                    continue
+                # Failed requests are not marked done, so a rerun asks for them again
+                if window_records is None:
+                    failed.append(task_id(futures[future]))
+                    continue
+                (tv_records if kind == 'total_value' else records).extend(window_records)
+                done.add(task_id(futures[future]))
+                save_progress()
+        if error is not None:
+            save_progress(force = True)
+            raise error
+        # An incomplete fetch is not stored, the rerun only asks for the failed requests
+        if failed:
+            save_progress(force = True)
+            raise RuntimeError(f"{len(failed)} of {len(tasks)} requests failed ({', '.join(sorted(failed)[:5])}), "
+                               f"the other requests are kept in the checkpoint for a rerun")
+        logging.info('Fetched the value and total_value metrics')
+
+        # Pivot all records to one row per date in a single step, the last value of a date and metric wins
+        columns = list(VALUE_METRICS) + ['FOLLOWER', 'NON_FOLLOWER'] + [metric for metric in TOTAL_VALUE_METRICS if metric not in BREAKDOWN_METRICS]
+        df_records = pd.DataFrame(records + tv_records, columns = ['date', 'metric', 'value'])
+        df_insights = (df_records.drop_duplicates(subset = ['date', 'metric'], keep = 'last')
+                       .pivot(index = 'date', columns = 'metric', values = 'value')
+                       .reindex(columns = columns)
+                       .convert_dtypes())
+        # Only the dates of the total_value metrics, which follow the since_req parameter, convenient for incremental loads
+        df_insights = df_insights[df_insights.index.isin({date for date, _, _ in tv_records})].sort_index()
+        logging.info(f'Pivoted {len(df_records)} records')
+
+        # Remove rows with empty values in the total_value columns
+        df_insights = df_insights.dropna(subset = columns[5:])
+        return df_insights
+
+    def ingest_account(instagram_business_account_id, token_secret_name):
+        # Get the Meta llat
+        page_access_token = get_secret(token_secret_name)
+
+        # Several accounts are stored as one dataset with a partition per account
+        account_folder = meta_graph.account_folder(folder_name, instagram_business_account_id)
+
+        # The requests of a backfill that outlasts the function timeout are spread over several runs of the same day
+        checkpoint = Checkpoint(account_name, account_key, container_name, account_folder,
+                                f'Insta_insights_{current_date}', key = {'since': since_str})
+        df_insights = fetch_account_insights(instagram_business_account_id, page_access_token,
+                                             meta_graph.account_budget(instagram_business_account_id), checkpoint)
+
+        # Setup IO string to prevent local storage
+        csv_buffer = StringIO()
+        df_insights.to_csv(csv_buffer, index = True, index_label = 'date', sep = ';')
+        csv_data = csv_buffer.getvalue()
+        logging.info('Set up the csv buffer')
+
+        ## Store the csv in the dls, in one upload that only replaces the blob once it is complete
+        store_in_dls(account_name, account_key, container_name, account_folder, csv_filename, csv_data)
+        logging.info(f'file of account {instagram_business_account_id} was uploaded')
+        checkpoint.clear()
+        return account_folder
+
+    _, skipped = meta_graph.for_each_account(accounts, ingest_account)
+    message, status_code = meta_graph.accounts_summary(
+        accounts, skipped, f'{csv_filename} was uploaded to {account_name}/{container_name}/{folder_name}')
+    return func.HttpResponse(message, status_code = status_code)
@@ -1,108 +1,139 @@
-import requests
 import logging
 import os
-import pandas as pd
+import json
 import azure.functions as func
-import datetime
-from azure.identity import ClientSecretCredential
-from azure.mgmt.storage import StorageManagementClient 
-from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
-from io import StringIO
-from azure.storage.blob import BlobServiceClient
+import meta_graph
+from datetime import datetime, timedelta, timezone
+from io import StringIO, BytesIO
+from dls import store_in_dls, download_from_dls
+from key_vault import get_secret, prefetch_secrets
+from checkpoint import Checkpoint
+from lazy_import import lazy_import
 
+pd = lazy_import('pandas')
 
-# Define your Azure AD credentials
-tenant_id = os.getenv('AR_TENANT_ID')
-client_id = os.getenv('AR_CLIENT_ID')
-client_secret = os.getenv('AR_APP_SECRET')
-
-# Authenticate using the service principal
-credential = ClientSecretCredential(tenant_id, client_id, client_secret)
-
-key_vault_url = 'https://kv-cd-databrein-d1.vault.azure.net/'
-client = SecretClient(vault_url=key_vault_url, credential=credential)
-
-# Function to retrieve secret from Key Vault
-def get_secret(secret_name):
-    secret = client.get_secret(secret_name)
-    return secret.value
+# Secrets used by this function, read together on the first request
+SECRETS = ('dls-databrein-d1-v2',)
 
 # Azure Data Lake Storage settings
 account_name = 'dlscddatabreind1'
-account_key = get_secret('dls-databrein-d1-v2')  # GET FROM KV?
 container_name = 'insta-csv-files'
 folder_name = 'Insta_media'  # Specify your desired folder
 # current_date = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d') # Use regular name since posts are not retrieved by date
 csv_filename = 'Insta_posts.csv'
 
-# Get the Meta llat
-page_access_token = get_secret('Meta-Page-Token')
-instagram_business_account_id = os.getenv('IG_BUSINESS_ACCOUNT_ID')
+fields = ['timestamp', 'id', 'caption', 'comments_count', 'like_count', 'media_product_type', 'media_type']
+# Fields every post has; the others are left out of a response when they are empty or hidden
+REQUIRED_FIELDS = ('timestamp', 'media_product_type', 'media_type')
 
-url = f'https://graph.facebook.com/v16.0/{instagram_business_account_id}/media?fields=id&access_token={page_access_token}'
+# Posts per page of the /media listing, pages that are too large are split by meta_graph
+MEDIA_PAGE_LIMIT = int(os.getenv('INSTA_MEDIA_PAGE_LIMIT', 100))
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
-  
-  def process_media_data(data, cols):
-      if 'data' in data:
-          rows = [item for item in data['data']]
-          #print(rows)
-          return pd.DataFrame(rows, columns = cols)
-      else:
-          return pd.DataFrame([data], columns = cols)
-  
-  def paging_calls_media(url, df, cols):
-      while url:
-          response = requests.get(url, params={})
-          if response.status_code != 200:
-              raise Exception(f"Request failed: {response.text}")
-          
-          data = response.json()
-          
-          # Process the current page data
-          df = pd.concat([df, process_media_data(data, cols)], ignore_index=True)
-          
-          # Check if there's a 'next' link in the pagination
-          if 'paging' in data and 'next' in data['paging']:
-              url = data['paging']['next']
-          else:
-              url = None
-      return df
-  
-  # Make the request to get media data
-  media_response = requests.get(url)
-  
-  # Check if the request was successful
-  print(f'Status Code: {media_response.status_code}')
-  
-  # Print the response text to debug
-  print(f'Response Text: {media_response.text}')
-  
-  # Initialize an empty DataFrame
-  df_media_ids = pd.DataFrame()
+# Incremental runs refresh the engagement of the posts of the last HOT_DAYS days and keep the older rows
+HOT_DAYS = int(os.getenv('INSTA_MEDIA_HOT_DAYS', 30))
+STATE_FILENAME = 'Insta_media_state.json'
+
+# Format of the Graph timestamps, e.g. 2024-05-01T10:00:00+0000
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+
+
+def load_state(account_key, folder):
+    """Timestamp of the newest stored post and the ids of all stored posts, an empty state on the first run."""
+    content = download_from_dls(account_name, account_key, container_name, folder, STATE_FILENAME)
+    if content is None:
+        return {'last_timestamp': None, 'post_ids': []}
+    return json.loads(content)
+
+
+def save_state(account_key, folder, df):
+    state = {
+        'last_timestamp': df['timestamp'].max() if len(df) else None,
+        'post_ids': df['id'].tolist(),
+    }
+    store_in_dls(account_name, account_key, container_name, folder, STATE_FILENAME, json.dumps(state))
+
+
+def sync_cutoff(state, now):
+    """Posts older than the cutoff are neither new nor hot, an incremental listing stops at them."""
+    hot_start = now - timedelta(days=HOT_DAYS)
+    if state['last_timestamp'] is None:
+        return None
+    return min(hot_start, datetime.strptime(state['last_timestamp'], TIMESTAMP_FORMAT))
+
+
+def list_posts(instagram_business_account_id, page_access_token, cutoff=None, known_ids=(), budget=None, checkpoint=None):
+    """Posts of the /media listing with all fields, newest first.
+
+    With a ``cutoff`` the listing stops at the first known post older than it, so later pages
+    are never requested. With a ``checkpoint`` the listing continues where a stopped run left it,
+    and the posts listed so far and the next page are saved every few pages.
+    """
+    progress = checkpoint.load() if checkpoint is not None else None
+    records = progress['records'] if progress else []
+    listing = meta_graph.pages(f'{instagram_business_account_id}/media',
+                               {'fields': ",".join(fields), 'limit': MEDIA_PAGE_LIMIT}, page_access_token, budget,
+                               resume_url=progress['next'] if progress else None)
+    next_url = None
+    try:
+        for page, next_url in listing:
+            for record in page:
+                if (cutoff is not None and record['id'] in known_ids and 'timestamp' in record
+                        and datetime.strptime(record['timestamp'], TIMESTAMP_FORMAT) < cutoff):
+                    return records
+                records.append(record)
+            if checkpoint is not None and next_url is not None:
+                checkpoint.save({'next': next_url, 'records': records})
+    except meta_graph.RateBudgetExceeded:
+        # The pages since the last checkpoint are kept for the next run as well
+        if checkpoint is not None and next_url is not None:
+            checkpoint.save({'next': next_url, 'records': records}, force=True)
+        raise
+    return records
+
+
+def merge_posts(existing, fetched):
+    """Replace the stored rows of the fetched posts and add the new ones, newest first."""
+    if existing is None:
+        return fetched
+    kept = existing[~existing['id'].isin(fetched['id'])]
+    merged = pd.concat([fetched, kept], ignore_index=True)
+    return merged.sort_values('timestamp', ascending=False, ignore_index=True)
+
+
+def sync_account(instagram_business_account_id, page_access_token, account_key, incremental):
+  """Fetch the new and hot posts of one account and merge them into its stored posts."""
+  folder = meta_graph.account_folder(folder_name, instagram_business_account_id)
+  budget = meta_graph.account_budget(instagram_business_account_id)
   
-  # Fetch and process paginated data
-  cols = ['id']
-  df_media_ids = paging_calls_media(url, df_media_ids, cols)
+  state = load_state(account_key, folder) if incremental else {'last_timestamp': None, 'post_ids': []}
+  existing = None
+  if state['last_timestamp'] is not None:
+      content = download_from_dls(account_name, account_key, container_name, folder, csv_filename)
+      if content is not None:
+          existing = pd.read_csv(BytesIO(content), sep = ';', dtype = {'id': str})
+  # Without the stored CSV there is nothing to merge into, so the run falls back to a full sync
+  cutoff = sync_cutoff(state, datetime.now(timezone.utc)) if existing is not None else None
   
-  fields = ['timestamp', 'id', 'caption', 'comments_count', 'like_count', 'media_product_type', 'media_type']
+  # Ask for every post field in the paginated listing itself, a few calls instead of one per post
   fields_join = ",".join(fields)
-  df_post_info = pd.DataFrame(columns = fields)
+  known_ids = set(state['post_ids'])
+  # A listing stopped by the function timeout resumes from its checkpoint, as long as the stored state is the same
+  checkpoint = Checkpoint(account_name, account_key, container_name, folder, 'Insta_media',
+                          key = {'last_timestamp': state['last_timestamp'] if existing is not None else None})
+  records = list_posts(instagram_business_account_id, page_access_token, cutoff, known_ids, budget, checkpoint)
+  new_posts = len([record for record in records if record['id'] not in known_ids])
+  logging.info(f'Listed {len(records)} posts of account {instagram_business_account_id}, {new_posts} of them new')
+  
+  # Posts the listing returned incomplete are fetched again through the batch endpoint, 50 per call
+  incomplete = [i for i, record in enumerate(records) if any(field not in record for field in REQUIRED_FIELDS)]
+  if incomplete:
+      bodies = meta_graph.batch([f"{records[i]['id']}?fields={fields_join}" for i in incomplete], page_access_token, budget)
+      for i, body in zip(incomplete, bodies):
+          if body is not None:
+              records[i] = body
+      logging.info(f'Fetched {len(incomplete)} incomplete posts in {-(-len(incomplete) // meta_graph.BATCH_SIZE)} batch calls')
   
-  for i, media_id in enumerate(df_media_ids['id']):
-      post_id = df_media_ids.iloc[i,0]
-      post_url = f'https://graph.facebook.com/v19.0/{post_id}?fields={fields_join}&access_token={page_access_token}'
-      #print(post_url)
-      
-      try:
-          post_response = requests.get(post_url)
-          post_data = post_response.json()
-          df = process_media_data(post_data, fields)
-          df_post_info = pd.concat([df_post_info, df], axis = 0, ignore_index=True)
-          
-      except requests.exceptions.RequestException as e:
-          print(f"Request failed for post ID {post_id}: {e}")
+  df_post_info = merge_posts(existing, pd.DataFrame.from_records(records, columns = fields))
   
   # Setup IO string to prevent local storage
   csv_buffer = StringIO()
@@ -110,16 +141,30 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
   csv_data = csv_buffer.getvalue()
   logging.info('Set up the csv buffer')
 
-  ## Store the csv in the dls
-  # Initialize BlobServiceClient with your Azure Storage account credentials
-  blob_service_client = BlobServiceClient(account_url=f"https://{account_name}.blob.core.windows.net",
-                                          credential=account_key)
-  logging.info('Initialized BlobServiceClient')
+  ## Store the csv in the dls, in one upload that only replaces the blob once it is complete
+  store_in_dls(account_name, account_key, container_name, folder, csv_filename, csv_data)
+  # Only move the watermark once the merged posts are stored, and only then drop the checkpoint
+  save_state(account_key, folder, df_post_info)
+  checkpoint.clear()
+  return folder
 
-  # Get a BlobClient for your Data Lake Storage folder
-  blob_client = blob_service_client.get_blob_client(container=container_name,
-                                                    blob=f"{folder_name}/{csv_filename}")
 
-  blob_client.upload_blob(csv_data, overwrite = True)
-
-  return func.HttpResponse(f'{csv_filename} was uploaded to {account_name}/{container_name}/{folder_name}')
+def main(req: func.HttpRequest) -> func.HttpResponse:
+  # Instagram accounts of this run, one or many (IG_ACCOUNTS)
+  accounts = meta_graph.instagram_accounts()
+  if not accounts:
+      return func.HttpResponse("No Instagram account is configured", status_code=500)
+  prefetch_secrets(SECRETS + tuple(secret_name for _, secret_name in accounts))
+  account_key = get_secret('dls-databrein-d1-v2')
+  
+  # Incremental runs only fetch new posts and the hot window, ?incremental=false refetches every post
+  incremental = req.params.get('incremental', 'true').lower() != 'false'
+  
+  def sync(instagram_business_account_id, token_secret_name):
+      # Get the Meta llat
+      return sync_account(instagram_business_account_id, get_secret(token_secret_name), account_key, incremental)
+  
+  _, skipped = meta_graph.for_each_account(accounts, sync)
+  message, status_code = meta_graph.accounts_summary(
+      accounts, skipped, f'{csv_filename} was uploaded to {account_name}/{container_name}/{folder_name}')
+  return func.HttpResponse(message, status_code = status_code)
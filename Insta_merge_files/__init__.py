@@ -1,81 +1,33 @@
-import requests
 import logging
 import os
-import pandas as pd
 import azure.functions as func
 import datetime
-import tempfile
-from azure.identity import ClientSecretCredential
-from azure.mgmt.storage import StorageManagementClient 
-from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
 import io
-from azure.storage.blob import BlobServiceClient
+import meta_graph
+from dls import store_in_dls, download_from_dls, list_in_dls, archive_in_dls
+from key_vault import get_secret
+from insights_store import write_day_partitions, load_insights
+from lazy_import import lazy_import
 
-# Define your Azure AD credentials
-tenant_id = os.getenv('AR_TENANT_ID')
-client_id = os.getenv('AR_CLIENT_ID')
-client_secret = os.getenv('AR_APP_SECRET')
-
-# Authenticate using the service principal
-credential = ClientSecretCredential(tenant_id, client_id, client_secret)
-
-key_vault_url = 'https://kv-cd-databrein-d1.vault.azure.net/'
-client = SecretClient(vault_url=key_vault_url, credential=credential)
-
-# Function to retrieve secret from Key Vault
-def get_secret(secret_name):
-    secret = client.get_secret(secret_name)
-    return secret.value
+pd = lazy_import('pandas')
 
 # Azure Data Lake Storage settings
 account_name = 'dlscddatabreind1'
-account_key = get_secret('dls-databrein-d1-v2')  # GET FROM KV?
 container_name = 'insta-csv-files'
 folder_name = 'Insta_insights'  # Specify your desired folder
 current_date = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
 csv_filename = f'Insta_insights_{current_date}.csv'
 
-def store_in_dls(account_name, account_key, folder_name, file_name, data):
-        # Initialize BlobServiceClient with your Azure Storage account credentials
-        blob_service_client = BlobServiceClient(account_url=f"https://{account_name}.blob.core.windows.net",
-                                                credential=account_key)
-
-        # Get a BlobClient for your Data Lake Storage folder
-        blob_client = blob_service_client.get_blob_client(container=container_name,
-                                                        blob=f"{folder_name}/{file_name}")
-
-        blob_client.upload_blob(data, overwrite = True)
-
-        return print(f'{file_name} was uploaded to the data lake storage')
-    
+# 'bulk' rewrites Insta_insights.csv with the daily file merged in, 'partitioned' only overwrites the
+# day partitions of the daily dates (see insights_store.py), ?mode= overrides it per request.
+# In partitioned mode ?export=true also rebuilds Insta_insights.csv from the partitions, for readers of the bulk file
+MERGE_MODE = os.getenv('INSTA_MERGE_MODE', 'bulk')
 
 def access_file_from_adls(account_name, account_key, container_name, folder_name, file_name):
     try:
-        # Initialize BlobServiceClient with your Azure Storage account credentials
-        logging.info("Initializing BlobServiceClient.")
-        blob_service_client = BlobServiceClient(account_url=f"https://{account_name}.blob.core.windows.net",
-                                                credential=account_key)
-
-        # Get a BlobClient for your Data Lake Storage file
-        logging.info("Getting BlobClient for the file.")
-        blob_client = blob_service_client.get_blob_client(container=container_name,
-                                                          blob=f"{folder_name}/{file_name}")
-
-        # Check if the blob exists
-        logging.info("Checking if blob exists.")
-        if not blob_client.exists():
-            logging.error(f"Blob {file_name} does not exist in the container {container_name}.")
-            return None
-
-        # Download the file content as bytes
+        # Download the file content as bytes through the shared storage clients
         logging.info("Downloading blob content.")
-        download_stream = blob_client.download_blob()
-
-        # Read the content in chunks
-        file_content = bytearray()
-        for chunk in download_stream.chunks():
-            file_content.extend(chunk)
+        file_content = download_from_dls(account_name, account_key, container_name, folder_name, file_name)
 
         if not file_content:
             logging.error("Failed to download blob content or content is empty.")
@@ -98,53 +50,78 @@ def create_temp_csv_string(df):
         csv_data = csv_buffer.getvalue()
         return csv_data
 
-from azure.storage.blob import BlobServiceClient
-
-def delete_file_from_adls(account_name, account_key, container_name, folder_name, file_name):
-    try:
-        # Initialize BlobServiceClient
-        blob_service_client = BlobServiceClient(account_url=f"https://{account_name}.blob.core.windows.net",
-                                                credential=account_key)
-
-        # Get a BlobClient for the file
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=f"{folder_name}/{file_name}")
-
-        # Delete the file
-        blob_client.delete_blob()
+def list_daily_files(account_name, account_key, container_name, folder_name):
+    """Daily files still waiting in the folder, oldest first, e.g. of days whose merge failed."""
+    prefix = f'{folder_name}/Insta_insights_'
+    return sorted(name[len(folder_name) + 1:] for name in list_in_dls(account_name, account_key, container_name, prefix)
+                  if name.endswith('.csv') and '/' not in name[len(folder_name) + 1:])
 
-        print(f"File deleted successfully: {folder_name}/{file_name}")
-
-    except Exception as e:
-        print(f"Error deleting the file: {e}")
 
-
-### Perform the merging and archiving of the files
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    
-    # Retrieve the necessary files
+def merge_folder(account_key, folder, mode, backlog=False, migrate=False, export=False):
+    """Merge the daily files of one account folder and archive them, returns the message and status code."""
+    # Retrieve the necessary files, with backlog every daily file in the folder is merged and archived at once
     bulk_file = 'Insta_insights.csv'
-    daily_file = csv_filename
-    bulk_df = access_file_from_adls(account_name, account_key, container_name, folder_name, bulk_file)
-    daily_df = access_file_from_adls(account_name, account_key, container_name, folder_name, daily_file)
+    daily_files = [csv_filename]
+    if backlog:
+        daily_files = list_daily_files(account_name, account_key, container_name, folder)
+    daily_dfs = [access_file_from_adls(account_name, account_key, container_name, folder, daily_file) for daily_file in daily_files]
+    daily_files = [daily_file for daily_file, df in zip(daily_files, daily_dfs) if df is not None]
+    if not daily_files:
+        return f"No daily file to merge in {folder}", 404
+    # A later daily file wins for the dates it shares with an earlier one
+    daily_df = (pd.concat([df for df in daily_dfs if df is not None], ignore_index=True)
+                .drop_duplicates(subset=['date'], keep='last'))
     
     # Remove empty rows from daily_df
     columns_to_check = [6, 7, 8]  # Assuming col1 and col2 by their index positions
     # Remove rows with empty values in specified columns
     daily_df = daily_df.dropna(subset=daily_df.columns[columns_to_check])
     
-    # Remove rows from bulk_df that are in daily_df
-    bulk_df_filtered = bulk_df[~bulk_df['date'].isin(daily_df['date'])]
-    # Merge the dataframes
-    merged_df = pd.concat([bulk_df_filtered, daily_df], ignore_index=True)
-
-    # Write merged data back to bulk data CSV.
-    bulk_csv_data = create_temp_csv_string(merged_df)  
-    store_in_dls(account_name, account_key, folder_name, bulk_file, bulk_csv_data)
-    # Write daily data to archive.
-    daily_csv_data = create_temp_csv_string(daily_df)
-    store_in_dls(account_name, account_key, 'Archief', daily_file, daily_csv_data)
-    
-    # Remove the daily file from its orignal folder (since it has been archived)
-    delete_file_from_adls(account_name, account_key, container_name, folder_name, daily_file)
+    if mode == 'partitioned':
+        # Only the days of the daily file are written, the time does not grow with the history
+        if migrate:
+            # One time: move the history of the bulk file into day partitions, Insta_compact_insights rolls them up
+            bulk_df = access_file_from_adls(account_name, account_key, container_name, folder, bulk_file)
+            if bulk_df is None:
+                return f"{folder}/{bulk_file} could not be read, nothing was migrated", 404
+            write_day_partitions(account_name, account_key, container_name, folder, bulk_df[~bulk_df['date'].isin(daily_df['date'])])
+        write_day_partitions(account_name, account_key, container_name, folder, daily_df)
+        if export:
+            history = load_insights(account_name, account_key, container_name, folder)
+            store_in_dls(account_name, account_key, container_name, folder, bulk_file, create_temp_csv_string(history))
+    else:
+        bulk_df = access_file_from_adls(account_name, account_key, container_name, folder, bulk_file)
+        # Remove rows from bulk_df that are in daily_df
+        bulk_df_filtered = bulk_df[~bulk_df['date'].isin(daily_df['date'])]
+        # Merge the dataframes
+        merged_df = pd.concat([bulk_df_filtered, daily_df], ignore_index=True)
+
+        # Write merged data back to bulk data CSV.
+        bulk_csv_data = create_temp_csv_string(merged_df)  
+        store_in_dls(account_name, account_key, container_name, folder, bulk_file, bulk_csv_data)
+    # Move the daily files to the archive with server-side copies and one batched delete, the bytes stay in the storage account.
+    # The archive keeps the account partition, the daily files of the accounts have the same names
+    archived = archive_in_dls(account_name, account_key, container_name,
+                              [f'{folder}/{daily_file}' for daily_file in daily_files], 'Archief' + folder[len(folder_name):])
         
-    return func.HttpResponse(f"Files {bulk_file} and {csv_filename} were merged and archived")
+    if mode == 'partitioned':
+        return f"{len(daily_files)} daily files of {folder} were written to {len(daily_df)} day partitions, {len(archived)} archived", 200
+    return f"{len(daily_files)} daily files were merged into {folder}/{bulk_file}, {len(archived)} archived", 200
+
+
+### Perform the merging and archiving of the files
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    account_key = get_secret('dls-databrein-d1-v2')
+    mode = req.params.get('mode', MERGE_MODE)
+    if mode not in ('bulk', 'partitioned'):
+        return func.HttpResponse("Invalid mode. Please use bulk or partitioned.", status_code=400)
+    backlog = req.params.get('backlog', 'false').lower() == 'true'
+    migrate = req.params.get('migrate', 'false').lower() == 'true'
+    export = req.params.get('export', 'false').lower() == 'true'
+
+    # Insta_insights writes a folder per account when there are several (IG_ACCOUNTS), every one is merged on its own
+    results = [merge_folder(account_key, folder, mode, backlog, migrate, export)
+               for folder in meta_graph.account_folders(folder_name)]
+    # Fails only when no folder could be merged
+    status_code = 200 if any(code == 200 for _, code in results) else results[0][1]
+    return func.HttpResponse("\n".join(message for message, _ in results), status_code=status_code)
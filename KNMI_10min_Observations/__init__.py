@@ -0,0 +1,163 @@
+import logging
+import os
+import json
+import time
+import azure.functions as func
+import http_client
+from dls import get_container_client, delete_many_in_dls
+from key_vault import get_secret, prefetch_secrets
+from datetime import datetime, timedelta
+from knmi import OpenDataAPI, open_dataset, normalize_dataset, station_codes, parquet_partitions, parse_list_param
+from lazy_import import lazy_import
+
+pd = lazy_import('pandas')
+
+
+logger = logging.getLogger(__name__)
+
+# Azure Data Lake Storage settings
+account_name = 'dlscddatabreind1'
+container_name = 'knmi-nc-files'
+folder_name = 'KNMI - Meteo data - 10min'  # Specify your desired folder
+parquet_folder = f'{folder_name}/KNMI_Data_10min'
+
+# 10-minute observations of the KNMI stations, one small file per time step
+dataset_name = "Actuele10mindataKNMIstations"
+dataset_version = "2"
+
+STATE_FILENAME = 'KNMI_10min_state.json'
+
+# Secrets used by this function, read together when the worker warms up
+SECRETS = ('KNMI-API-Key', 'dls-databrein-d1-v2')
+
+# Days of 10-minute data kept in the rolling store
+RETENTION_DAYS = int(os.environ.get("KNMI_10MIN_RETENTION_DAYS", 30))
+# Seconds a single file may take from listing to stored partition before we log a warning
+FILE_LATENCY_BUDGET = float(os.environ.get("KNMI_10MIN_FILE_LATENCY_BUDGET", 10))
+# Stop picking up files after this many seconds, so runs do not overlap with the next timer tick
+RUN_BUDGET = float(os.environ.get("KNMI_10MIN_RUN_BUDGET", 90))
+MAX_FILES_PER_RUN = int(os.environ.get("KNMI_10MIN_MAX_FILES", 12))
+
+# Comma separated selection, all stations and variables when not set
+STATIONS = parse_list_param(os.environ.get("KNMI_10MIN_STATIONS"))
+VARIABLES = parse_list_param(os.environ.get("KNMI_10MIN_VARIABLES"))
+
+# Clients stay warm between invocations on the same worker, the state is read on every run because
+# another instance may have moved it on
+_api = None
+_container_client = None
+
+
+def load_state(container_client):
+    """Read the last processed file and time step, an empty state on the first run."""
+    blob_client = container_client.get_blob_client(f"{folder_name}/{STATE_FILENAME}")
+    if not blob_client.exists():
+        return {'last_filename': None, 'last_time': None, 'pruned_date': None}
+    return json.loads(blob_client.download_blob().readall())
+
+
+def save_state(container_client, state):
+    blob_client = container_client.get_blob_client(f"{folder_name}/{STATE_FILENAME}")
+    blob_client.upload_blob(json.dumps(state, indent=2), overwrite=True)
+
+
+def warm_up():
+    """Create the KNMI client and the container client once per worker."""
+    global _api, _container_client
+
+    prefetch_secrets(SECRETS)
+    if _api is None:
+        _api = OpenDataAPI(api_token=get_secret('KNMI-API-Key'))
+    if _container_client is None:
+        _container_client = get_container_client(account_name, get_secret('dls-databrein-d1-v2'), container_name)
+
+    return _api, _container_client
+
+
+def list_new_files(api, state):
+    """Files published after the last processed one, oldest first. Only the latest file on the first run."""
+    if state['last_filename'] is None:
+        params = {"maxKeys": 1, "orderBy": "created", "sorting": "desc"}
+    else:
+        params = {"maxKeys": MAX_FILES_PER_RUN, "orderBy": "filename", "sorting": "asc",
+                  "startAfterFilename": state['last_filename']}
+
+    response = api.list_files(dataset_name, dataset_version, params)
+    if "error" in response:
+        raise RuntimeError(f"Unable to retrieve list of files: {response['error']}")
+    return response.get("files", [])
+
+
+def process_file(api, container_client, state, filename):
+    """Download one 10-minute file into memory, keep only its new time steps and append them to the store."""
+    start = time.perf_counter()
+
+    response = api.get_file_url(dataset_name, dataset_version, filename)
+    download = http_client.get(response["temporaryDownloadUrl"])
+    download.raise_for_status()
+
+    with open_dataset(memoryview(download.content)) as dataset:
+        stations = STATIONS or station_codes(dataset)
+        df = normalize_dataset(dataset, stations, VARIABLES, daily=False)
+
+    if state['last_time'] is not None:
+        df = df[df['Time'] > pd.Timestamp(state['last_time'])]
+
+    # The part file is named after the source file, so reprocessing a file overwrites its own part
+    part_name = os.path.splitext(filename)[0]
+    for partition_path, data in parquet_partitions(df, part_name, partition_by=('Date',)):
+        container_client.upload_blob(f"{parquet_folder}/{partition_path}", data, overwrite=True)
+
+    state['last_filename'] = filename
+    if df['Time'].notna().any():
+        state['last_time'] = df['Time'].max().isoformat()
+
+    elapsed = time.perf_counter() - start
+    if elapsed > FILE_LATENCY_BUDGET:
+        logger.warning(f"{filename} took {elapsed:.1f}s, over the budget of {FILE_LATENCY_BUDGET:.0f}s")
+    logger.info(f"{len(df)} new rows of {filename} were stored in {elapsed:.1f}s")
+
+
+def prune_partitions(container_client, state, today):
+    """Delete the Date partitions that fell out of the retention window, once per day."""
+    if state.get('pruned_date') == today.isoformat():
+        return
+
+    oldest = (today - timedelta(days=RETENTION_DAYS)).isoformat()
+    for partition in container_client.walk_blobs(name_starts_with=f"{parquet_folder}/Date=", delimiter='/'):
+        date = partition.name.rstrip('/').rsplit('=', 1)[-1]
+        if date >= oldest:
+            continue
+        names = [blob.name for blob in container_client.list_blobs(name_starts_with=partition.name)]
+        delete_many_in_dls(account_name, get_secret('dls-databrein-d1-v2'), container_name, names)
+        logger.info(f"Pruned partition {partition.name} ({len(names)} files)")
+
+    state['pruned_date'] = today.isoformat()
+
+
+def main(mytimer: func.TimerRequest) -> None:
+    if mytimer.past_due:
+        logger.info('The timer is past due')
+
+    start = time.perf_counter()
+    api, container_client = warm_up()
+    state = load_state(container_client)
+
+    files = list_new_files(api, state)
+    if not files:
+        logger.info("No new 10-minute files")
+        return
+
+    processed = 0
+    for file_info in files:
+        if time.perf_counter() - start > RUN_BUDGET:
+            logger.info(f"Run budget of {RUN_BUDGET:.0f}s used, leaving {len(files) - processed} files for the next run")
+            break
+        process_file(api, container_client, state, file_info["filename"])
+        # Save after every file, so a recycled worker does not process it again
+        save_state(container_client, state)
+        processed += 1
+
+    prune_partitions(container_client, state, datetime.utcnow().date())
+    save_state(container_client, state)
+    logger.info(f"Processed {processed} 10-minute files in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,117 @@
+"""Cold-start benchmark of the function directories: import time and first-request latency.
+
+Every measurement runs in a fresh interpreter, like a worker that scales from zero, and is taken with
+the lazy imports of ``lazy_import.py`` and with eager imports (``LAZY_IMPORTS=false``) for comparison.
+
+    python benchmarks/cold_start.py --repeat 5
+    python benchmarks/cold_start.py --functions Download_KNMI_Report --first-request --params "output=csv"
+
+The first request calls the real services with the secrets and settings of the environment (the values
+of local.settings.json), so it is only measured with ``--first-request``.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Dependencies whose import shows up in the cold start
+HEAVY_MODULES = ['pandas', 'numpy', 'netCDF4', 'pyarrow', 'sqlalchemy', 'pyodbc', 'azure.storage.blob',
+                 'azure.keyvault.secrets', 'azure.identity', 'azure.mgmt.storage', 'google.analytics.data_v1beta']
+
+
+def function_directories():
+    return sorted(name for name in os.listdir(ROOT)
+                  if os.path.isfile(os.path.join(ROOT, name, 'function.json')))
+
+
+def is_loaded(name):
+    """Whether the module was imported, the stand-ins of ``lazy_import`` are not registered until used."""
+    return name in sys.modules
+
+
+def trigger_argument(function_name, params):
+    """The argument ``main`` gets from the host: an HTTP request or a timer."""
+    import azure.functions as func
+    from types import SimpleNamespace
+    from urllib.parse import parse_qsl
+
+    with open(os.path.join(ROOT, function_name, 'function.json')) as f:
+        bindings = json.load(f)['bindings']
+    trigger = next(binding['type'] for binding in bindings if binding['direction'] == 'in')
+
+    if trigger == 'timerTrigger':
+        return SimpleNamespace(past_due=False)
+    return func.HttpRequest(method='GET', url=f'/api/{function_name}', params=dict(parse_qsl(params)), body=b'')
+
+
+def measure(function_name, first_request, params):
+    """Runs in the child interpreter: import the function and optionally serve one request."""
+    sys.path.insert(0, ROOT)
+    result = {}
+
+    start = time.perf_counter()
+    module = __import__(function_name)
+    result['import_s'] = time.perf_counter() - start
+    result['heavy_at_import'] = [name for name in HEAVY_MODULES if is_loaded(name)]
+
+    if first_request:
+        argument = trigger_argument(function_name, params)
+        start = time.perf_counter()
+        response = module.main(argument)
+        result['first_request_s'] = time.perf_counter() - start
+        result['status_code'] = getattr(response, 'status_code', None)
+        result['heavy_after_request'] = [name for name in HEAVY_MODULES if is_loaded(name)]
+
+    print(json.dumps(result))
+
+
+def run_child(function_name, lazy, first_request, params):
+    env = dict(os.environ, LAZY_IMPORTS='true' if lazy else 'false')
+    command = [sys.executable, os.path.abspath(__file__), '--child', function_name, '--params', params]
+    if first_request:
+        command.append('--first-request')
+    completed = subprocess.run(command, capture_output=True, text=True, env=env, cwd=ROOT)
+    if completed.returncode != 0:
+        error = completed.stderr.strip().splitlines()
+        raise RuntimeError(error[-1] if error else f"exit code {completed.returncode}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def summarize(runs, key):
+    values = [run[key] for run in runs if key in run]
+    return f"{statistics.median(values) * 1000:8.0f} ms" if values else f"{'-':>11}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--functions', nargs='*', default=None, help='function directories, all by default')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--first-request', action='store_true', help='also time one call of main')
+    parser.add_argument('--params', default='', help='query string of the first request')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure(args.child, args.first_request, args.params)
+        return
+
+    print(f"{'function':<26}{'imports':<8}{'import':>11}{'first request':>15}  heavy modules at import")
+    for function_name in args.functions or function_directories():
+        for lazy in (True, False):
+            mode = 'lazy' if lazy else 'eager'
+            try:
+                runs = [run_child(function_name, lazy, args.first_request, args.params) for _ in range(args.repeat)]
+            except RuntimeError as e:
+                print(f"{function_name:<26}{mode:<8} failed: {e}")
+                continue
+            heavy = ', '.join(runs[-1]['heavy_at_import']) or '-'
+            print(f"{function_name:<26}{mode:<8}{summarize(runs, 'import_s')}{summarize(runs, 'first_request_s'):>15}  {heavy}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Benchmark of the vectorized KNMI normalization against the original per-row loop.
+
+Builds a synthetic daily station file in memory with the same layout as ``etmaalgegevensKNMIstations``
+(variables over ``(station, time)``, time in seconds since 1950) and times both implementations on it.
+
+    python benchmarks/knmi_normalize.py --days 27000 --stations 50 --variables 40
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knmi import EXCLUDED_VARS, normalize_dataset  # noqa: E402
+
+
+def build_dataset(days, stations, variables, fill_ratio=0.05, seed=0):
+    """Create an in-memory NetCDF dataset shaped like the KNMI daily station file."""
+    rng = np.random.default_rng(seed)
+    dataset = nc.Dataset('synthetic.nc', 'w', diskless=True, persist=False)
+    dataset.createDimension('station', stations)
+    dataset.createDimension('time', days)
+
+    # WMO ids, with De Bilt (06260) at position 18 like in the real file
+    station = dataset.createVariable('station', str, ('station',))
+    for i in range(stations):
+        station[i] = f'06{242 + i}'
+
+    time_var = dataset.createVariable('time', 'f8', ('time',))
+    time_var.units = 'seconds since 1950-01-01 00:00:00'
+    time_var[:] = (np.arange(days) + 1) * 86400.0
+
+    for v in range(variables):
+        var = dataset.createVariable(f'V{v:02d}', 'f4', ('station', 'time'), fill_value=-9999.0)
+        var.long_name = f'Variable {v:02d}'
+        values = rng.normal(size=(stations, days)).astype('f4')
+        values[rng.random(size=values.shape) < fill_ratio] = -9999.0
+        var[:] = np.ma.masked_equal(values, -9999.0)
+
+    return dataset
+
+
+def legacy_normalize(dataset):
+    """The per-row dict loop that ``create_normalized_df`` used before it was vectorized."""
+    reference_date = datetime(1950, 1, 1, 0, 0, 0)
+
+    def convert_time_to_date(num_time, time_units):
+        if time_units.startswith('days since'):
+            return reference_date + timedelta(days=num_time - 1)
+        elif time_units.startswith('seconds since'):
+            return reference_date + timedelta(seconds=num_time)
+        else:
+            raise ValueError("Unsupported time units. Supported units are 'days since' or 'seconds since'.")
+
+    time_var = dataset.variables['time']
+    times = [convert_time_to_date(time_val, time_var.units) for time_val in time_var[:]]
+
+    variable_names = [var for var in dataset.variables.keys() if var not in EXCLUDED_VARS]
+    variables = {var_name: dataset.variables[var_name][:] for var_name in variable_names}
+    long_names = {var_name: dataset.variables[var_name].long_name for var_name in variable_names}
+
+    data = []
+    for j, t in enumerate(times):
+        row = {
+            'Station': '260',
+            'Time': t,
+        }
+        for var_name in variable_names:
+            row[long_names[var_name]] = variables[var_name][18, j]
+        data.append(row)
+
+    df = pd.DataFrame(data)
+    df['Time'] = df['Time'] - pd.Timedelta(days=1)
+    return df
+
+
+def best_of(func, dataset, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(dataset)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=int, default=27000)
+    parser.add_argument('--stations', type=int, default=50)
+    parser.add_argument('--variables', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with build_dataset(args.days, args.stations, args.variables) as dataset:
+        legacy_time, legacy_df = best_of(legacy_normalize, dataset, args.repeat)
+        vector_time, vector_df = best_of(normalize_dataset, dataset, args.repeat)
+
+    # Both implementations must produce the same frame; the loop leaves np.ma.masked where the vectorized one has NaN
+    pd.testing.assert_series_equal(legacy_df['Time'], vector_df['Time'], check_dtype=False)
+    for column in vector_df.columns[2:]:
+        legacy_values = legacy_df[column].map(lambda v: np.nan if v is np.ma.masked else float(v))
+        np.testing.assert_allclose(legacy_values, vector_df[column])
+
+    print(f"{args.days} days x {args.variables} variables ({args.stations} stations in the file)")
+    print(f"per-row loop: {legacy_time:.3f} s")
+    print(f"vectorized:   {vector_time:.3f} s")
+    print(f"speed-up:     {legacy_time / vector_time:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import json
+import logging
+import os
+import time
+from dls import get_blob_client, store_in_dls, delete_from_dls
+
+logger = logging.getLogger(__name__)
+
+# Pages (or requests) fetched between two checkpoints
+CHECKPOINT_EVERY = int(os.getenv('CHECKPOINT_EVERY', 5))
+# Older checkpoints are dropped, the paging cursors in them have expired by then
+CHECKPOINT_MAX_AGE = float(os.getenv('CHECKPOINT_MAX_AGE_HOURS', 24)) * 3600
+# Checkpoints are kept apart from the data, so nothing that reads the data folders picks them up
+CHECKPOINT_FOLDER = '_checkpoints'
+
+
+class Checkpoint:
+    """Progress of a long fetch in the data lake, so a run that is stopped by the function timeout or a
+    recycled worker is resumed by the next run instead of starting again from the first page.
+
+    ``key`` holds the parameters of the fetch, a checkpoint of a fetch with other parameters is ignored.
+    """
+
+    def __init__(self, account_name, account_key, container_name, folder, name, key=None, every=CHECKPOINT_EVERY):
+        self.account_name = account_name
+        self.account_key = account_key
+        self.container_name = container_name
+        self.folder = f'{CHECKPOINT_FOLDER}/{folder}'
+        self.file_name = f'{name}.json'
+        self.key = key or {}
+        self.every = every
+        self.pending = 0
+
+    def load(self):
+        """Saved progress, ``None`` when there is no usable checkpoint."""
+        blob_client = get_blob_client(self.account_name, self.account_key, self.container_name,
+                                      f'{self.folder}/{self.file_name}')
+        if not blob_client.exists():
+            return None
+        checkpoint = json.loads(blob_client.download_blob().readall())
+        if checkpoint.get('key') != self.key:
+            logger.info(f'Ignored checkpoint {self.folder}/{self.file_name} of a fetch with other parameters')
+            return None
+        if time.time() - checkpoint['saved_at'] > CHECKPOINT_MAX_AGE:
+            logger.info(f'Ignored expired checkpoint {self.folder}/{self.file_name}')
+            return None
+        logger.info(f'Resuming from checkpoint {self.folder}/{self.file_name}')
+        return checkpoint['state']
+
+    def save(self, state, force=False):
+        """Store ``state`` every ``every`` calls, or right away with ``force``."""
+        self.pending += 1
+        if self.pending < self.every and not force:
+            return
+        checkpoint = {'key': self.key, 'saved_at': time.time(), 'state': state}
+        store_in_dls(self.account_name, self.account_key, self.container_name, self.folder, self.file_name,
+                     json.dumps(checkpoint))
+        self.pending = 0
+
+    def clear(self):
+        """Remove the checkpoint once the output of the fetch is stored."""
+        blob_client = get_blob_client(self.account_name, self.account_key, self.container_name,
+                                      f'{self.folder}/{self.file_name}')
+        if blob_client.exists():
+            delete_from_dls(self.account_name, self.account_key, self.container_name, self.folder, self.file_name)
@@ -0,0 +1,139 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Connections kept alive per storage host, enough for the parallel block uploads
+POOL_MAXSIZE = 32
+
+# Clients are cached per account for the life of the worker, so every storage call after the
+# first one reuses the same connection pool instead of paying for a new TLS handshake
+_service_clients = {}
+_container_clients = {}
+_lock = threading.Lock()
+
+
+def get_blob_service_client(account_name, account_key):
+    """Shared ``BlobServiceClient`` of the storage account."""
+    key = (account_name, account_key)
+    with _lock:
+        if key not in _service_clients:
+            # The storage SDK is imported with the first client, not when a function module loads
+            from azure.core.pipeline.transport import RequestsTransport
+            from azure.storage.blob import BlobServiceClient
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            _service_clients[key] = BlobServiceClient(
+                account_url=f"https://{account_name}.blob.core.windows.net",
+                credential=account_key,
+                transport=RequestsTransport(session=session, session_owner=False),
+            )
+            logger.info(f"Initialized BlobServiceClient for {account_name}")
+        return _service_clients[key]
+
+
+def get_container_client(account_name, account_key, container_name):
+    """Shared ``ContainerClient``, built on the shared service client of the account."""
+    key = (account_name, account_key, container_name)
+    if key not in _container_clients:
+        service_client = get_blob_service_client(account_name, account_key)
+        with _lock:
+            _container_clients.setdefault(key, service_client.get_container_client(container_name))
+    return _container_clients[key]
+
+
+def get_blob_client(account_name, account_key, container_name, blob_name):
+    return get_container_client(account_name, account_key, container_name).get_blob_client(blob_name)
+
+
+def store_in_dls(account_name, account_key, container_name, folder_name, file_name, data, **kwargs):
+    """Upload ``data`` to ``folder_name/file_name``, overwriting an existing blob.
+
+    The blob is only replaced when the upload is committed, so readers never see a partial file.
+    """
+    blob_client = get_blob_client(account_name, account_key, container_name, f"{folder_name}/{file_name}")
+    blob_client.upload_blob(data, overwrite=True, **kwargs)
+    logger.info(f"{file_name} was uploaded to {container_name}/{folder_name}")
+
+
+def download_from_dls(account_name, account_key, container_name, folder_name, file_name):
+    """Content of ``folder_name/file_name`` as bytes, ``None`` when the blob does not exist."""
+    blob_client = get_blob_client(account_name, account_key, container_name, f"{folder_name}/{file_name}")
+    if not blob_client.exists():
+        logger.error(f"Blob {file_name} does not exist in the container {container_name}.")
+        return None
+    return blob_client.download_blob().readall()
+
+
+def delete_from_dls(account_name, account_key, container_name, folder_name, file_name):
+    blob_client = get_blob_client(account_name, account_key, container_name, f"{folder_name}/{file_name}")
+    blob_client.delete_blob()
+    logger.info(f"File deleted successfully: {folder_name}/{file_name}")
+
+
+def list_in_dls(account_name, account_key, container_name, prefix):
+    """Names of all blobs whose name starts with ``prefix``."""
+    container_client = get_container_client(account_name, account_key, container_name)
+    return [blob.name for blob in container_client.list_blobs(name_starts_with=prefix)]
+
+
+# Blobs per call of the blob batch API
+DELETE_BATCH_SIZE = 256
+# Seconds a server-side copy may take before it is reported as failed
+COPY_TIMEOUT = 60
+# Server-side copies started and polled at the same time
+MAX_CONCURRENT_COPIES = 16
+
+
+def copy_in_dls(account_name, account_key, container_name, source_name, target_name):
+    """Start a server-side copy of ``source_name`` to ``target_name``, the bytes stay in the storage account."""
+    source_client = get_blob_client(account_name, account_key, container_name, source_name)
+    target_client = get_blob_client(account_name, account_key, container_name, target_name)
+    target_client.start_copy_from_url(source_client.url)
+    return target_client
+
+
+def wait_for_copy(target_client, timeout=COPY_TIMEOUT):
+    """Whether the copy to ``target_client`` succeeded; copies within one account mostly finish right away."""
+    deadline = time.monotonic() + timeout
+    while True:
+        status = target_client.get_blob_properties().copy.status
+        if status != 'pending' or time.monotonic() > deadline:
+            return status == 'success'
+        time.sleep(0.5)
+
+
+def delete_many_in_dls(account_name, account_key, container_name, blob_names):
+    """Delete ``blob_names`` with the blob batch API, 256 per call instead of one call per blob."""
+    container_client = get_container_client(account_name, account_key, container_name)
+    for i in range(0, len(blob_names), DELETE_BATCH_SIZE):
+        container_client.delete_blobs(*blob_names[i:i + DELETE_BATCH_SIZE])
+    logger.info(f"Deleted {len(blob_names)} blobs from {container_name}")
+
+
+def archive_in_dls(account_name, account_key, container_name, blob_names, archive_folder):
+    """Move ``blob_names`` into ``archive_folder`` with server-side copies and batched deletes.
+
+    The copies are started and polled by a bounded thread pool, a source is only deleted once its
+    copy succeeded. Returns the names that were archived.
+    """
+    def copy(name):
+        return wait_for_copy(copy_in_dls(account_name, account_key, container_name, name,
+                                         f"{archive_folder}/{name.split('/')[-1]}"))
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_COPIES) as executor:
+        copied = list(executor.map(copy, blob_names))
+    archived = [name for name, succeeded in zip(blob_names, copied) if succeeded]
+    failed = set(blob_names) - set(archived)
+    if failed:
+        logger.error(f"Copy to {archive_folder} failed for {', '.join(sorted(failed))}, they are kept in place")
+    if archived:
+        delete_many_in_dls(account_name, account_key, container_name, archived)
+    logger.info(f"Archived {len(archived)} blobs to {container_name}/{archive_folder}")
+    return archived
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import requests
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+# Optional cache of source API responses under http_client, meant for local development and reruns.
+# Off unless HTTP_CACHE=true, e.g. in local.settings.json
+ENABLED = os.getenv('HTTP_CACHE', 'false').lower() == 'true'
+CACHE_DIR = os.getenv('HTTP_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'http_cache'))
+# Least recently used responses are evicted above this size
+MAX_BYTES = int(os.getenv('HTTP_CACHE_MAX_MB', 256)) * 1024 * 1024
+
+# Seconds a response is used without asking the source, per endpoint; the first matching pattern applies.
+# After that it is revalidated with If-None-Match/If-Modified-Since when the source sent an ETag or
+# Last-Modified, and fetched again otherwise. Endpoints without a policy are never cached.
+POLICIES = [
+    # Insights change during the day
+    (re.compile(r'^https://graph\.facebook\.com/[^/]+/\d+/insights'), ('GET',), 300),
+    (re.compile(r'^https://graph\.facebook\.com/'), ('GET',), 3600),
+    # A new 10-minute file is published every 10 minutes, the temporary download urls are not cached
+    (re.compile(r'^https://api\.dataplatform\.knmi\.nl/open-data/v1/datasets/[^/]+/versions/[^/]+/files(\?|$)'), ('GET',), 120),
+    # The CustomDecks export is a POST that only reads
+    (re.compile(r'^https://customdecks\.be/admin/plugins/'), ('GET', 'POST'), 900),
+]
+
+# Response headers kept with a response; rate-limit usage and the like belong to the original call only
+STORED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Date')
+
+# Access tokens in stored bodies, e.g. in the paging links of the Graph API (also JSON escaped)
+ACCESS_TOKEN_PATTERN = re.compile(rb'access_token=[^&"\\\s]*')
+
+_lock = threading.Lock()
+
+
+def policy_ttl(method, url):
+    """Seconds a response of ``method url`` stays fresh, ``None`` when it is not cached."""
+    if not ENABLED:
+        return None
+    for pattern, methods, ttl in POLICIES:
+        if pattern.match(url):
+            return ttl if method.upper() in methods else None
+    return None
+
+
+def cache_key(method, url, params=None, data=None, headers=None):
+    """Hash of everything that selects the response, so the credentials in it only end up in the hash."""
+    prepared = requests.Request(method.upper(), url, params=params, data=data).prepare()
+    # The order of the query parameters does not select anything, e.g. a paging link with its token set again
+    parts = urlsplit(prepared.url)
+    canonical_url = urlunsplit(parts._replace(query=urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))))
+    authorization = (headers or {}).get('Authorization', '')
+    material = json.dumps([prepared.method, canonical_url, str(prepared.body), authorization])
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+def _paths(key):
+    return os.path.join(CACHE_DIR, f'{key}.json'), os.path.join(CACHE_DIR, f'{key}.body')
+
+
+def load(key):
+    """Stored entry ``key`` with its body, ``None`` when it is not in the cache."""
+    meta_path, body_path = _paths(key)
+    try:
+        with open(meta_path) as f:
+            entry = json.load(f)
+        with open(body_path, 'rb') as f:
+            entry['body'] = f.read()
+        # The modification time of the body is the last use for the LRU eviction
+        os.utime(body_path)
+    except (FileNotFoundError, ValueError):
+        return None
+    return entry
+
+
+def _write(path, content, mode):
+    # Write next to the target and rename, so a reader never sees half an entry
+    fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR)
+    with os.fdopen(fd, mode) as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+def save(key, response, stored_at=None):
+    """Store ``response`` without credentials: the url loses its query string (access tokens, the
+    CustomDecks login) and access tokens in the body are emptied, ``meta_graph.pages`` sets the
+    token of the run again on the paging links."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    meta_path, body_path = _paths(key)
+    entry = {
+        'stored_at': stored_at or time.time(),
+        'status_code': response.status_code,
+        'url': response.url.split('?')[0],
+        'encoding': response.encoding,
+        'headers': {name: response.headers[name] for name in STORED_HEADERS if name in response.headers},
+    }
+    _write(body_path, ACCESS_TOKEN_PATTERN.sub(b'access_token=', response.content), 'wb')
+    _write(meta_path, json.dumps(entry), 'w')
+    evict()
+
+
+def refresh(key, entry):
+    """Mark a revalidated entry fresh again."""
+    meta_path, _ = _paths(key)
+    meta = {name: value for name, value in entry.items() if name != 'body'}
+    meta['stored_at'] = time.time()
+    _write(meta_path, json.dumps(meta), 'w')
+
+
+def evict():
+    """Remove the least recently used entries until the cache fits in ``MAX_BYTES``."""
+    with _lock:
+        bodies = []
+        total = 0
+        for item in os.scandir(CACHE_DIR):
+            if item.name.endswith('.body'):
+                stat = item.stat()
+                bodies.append((stat.st_mtime, stat.st_size, item.name[:-len('.body')]))
+                total += stat.st_size
+        for _, size, key in sorted(bodies):
+            if total <= MAX_BYTES:
+                break
+            for path in _paths(key):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+
+def is_fresh(entry, ttl):
+    return time.time() - entry['stored_at'] < ttl
+
+
+def conditional_headers(entry):
+    """Headers that ask the source to answer 304 when the stored response is still current."""
+    headers = {}
+    if 'ETag' in entry['headers']:
+        headers['If-None-Match'] = entry['headers']['ETag']
+    if 'Last-Modified' in entry['headers']:
+        headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+    return headers
+
+
+def to_response(entry, headers=None):
+    """``requests.Response`` of a stored entry, ``from_cache`` tells whether the source was asked at all."""
+    response = requests.Response()
+    response.status_code = entry['status_code']
+    response.url = entry['url']
+    response.encoding = entry['encoding']
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response._content = entry['body']
+    response.from_cache = headers is None
+    if headers is not None:
+        # A 304 carries the current headers of the source
+        response.headers.update(headers)
+    return response
@@ -0,0 +1,115 @@
+import logging
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import http_cache
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeout of every call in seconds
+TIMEOUT = (float(os.getenv('HTTP_CONNECT_TIMEOUT', 10)), float(os.getenv('HTTP_READ_TIMEOUT', 60)))
+
+# Retries of throttled (429), failing (5xx) and dropped calls, with exponential backoff and full jitter
+MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 5))
+BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', 0.5))
+BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', 30))
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Connections kept alive per host; callers beyond the limit wait for a free connection
+POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 16))
+# Number of hosts whose pools are kept
+POOL_CONNECTIONS = 8
+
+# One session for the life of the worker, so calls to the same host reuse the TLS connection
+_session = None
+_lock = threading.Lock()
+
+
+def get_session():
+    """Shared ``requests.Session`` with a bounded connection pool per host."""
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, pool_block=True)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Seconds to wait before retry ``attempt`` (0-based), at least the ``Retry-After`` of the server."""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    try:
+        return max(delay, float(retry_after)) if retry_after is not None else delay
+    except ValueError:
+        # Retry-After can also be an HTTP date, the backoff is good enough then
+        return delay
+
+
+def request(method, url, retries=MAX_RETRIES, timeout=TIMEOUT, cache_only=False, retry_statuses=RETRY_STATUSES,
+            **kwargs):
+    """Send a request over the shared session and retry it on 429, 5xx, timeouts and dropped connections.
+
+    The response of the last attempt is returned as it is, so callers still check its status.
+    ``retry_statuses`` replaces the retried statuses, e.g. for callers that handle 429 themselves.
+    A timeout or connection error of the last attempt is raised.
+    With ``HTTP_CACHE=true`` the endpoints with a cache policy are answered from the cache while fresh,
+    and revalidated with a conditional request after that. Streamed downloads are never cached.
+    With ``cache_only`` nothing is sent, the fresh cached response or ``None`` is returned.
+    """
+    ttl = None if kwargs.get('stream') else http_cache.policy_ttl(method, url)
+    if ttl is None:
+        return None if cache_only else send(method, url, retries, timeout, retry_statuses, **kwargs)
+
+    key = http_cache.cache_key(method, url, kwargs.get('params'), kwargs.get('data'), kwargs.get('headers'))
+    entry = http_cache.load(key)
+    if entry is not None and http_cache.is_fresh(entry, ttl):
+        logger.info(f"{method} {url.split('?')[0]} was answered from the cache")
+        return http_cache.to_response(entry)
+    if cache_only:
+        return None
+    if entry is not None:
+        kwargs['headers'] = dict(kwargs.get('headers') or {}, **http_cache.conditional_headers(entry))
+
+    response = send(method, url, retries, timeout, retry_statuses, **kwargs)
+    if response.status_code == 304 and entry is not None:
+        http_cache.refresh(key, entry)
+        return http_cache.to_response(entry, response.headers)
+    if response.status_code == 200:
+        http_cache.save(key, response)
+    return response
+
+
+def send(method, url, retries=MAX_RETRIES, timeout=TIMEOUT, retry_statuses=RETRY_STATUSES, **kwargs):
+    """``request`` without the cache."""
+    session = get_session()
+    for attempt in range(retries + 1):
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == retries:
+                raise
+            delay = backoff_delay(attempt)
+            reason = type(e).__name__
+        else:
+            if response.status_code not in retry_statuses or attempt == retries:
+                return response
+            delay = backoff_delay(attempt, response.headers.get('Retry-After'))
+            reason = f"status {response.status_code}"
+            response.close()
+
+        logger.warning(f"{method} {url.split('?')[0]} failed with {reason}, retry {attempt + 1} of {retries} in {delay:.1f}s")
+        time.sleep(delay)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
@@ -0,0 +1,131 @@
+import calendar
+import datetime
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+from dls import store_in_dls, download_from_dls, delete_many_in_dls, list_in_dls
+from lazy_import import lazy_import
+
+pd = lazy_import('pandas')
+
+logger = logging.getLogger(__name__)
+
+# Date partitioned store of the Instagram insights: one small CSV per day, rolled up per month into Parquet.
+# Replacing a day only overwrites its own partition, whatever the length of the history.
+# Every account folder (see meta_graph.account_folder) has its own store:
+#   Insta_insights[/account_id=<id>]/partitions/date=2024-05-01/Insta_insights.csv
+#   Insta_insights[/account_id=<id>]/compacted/month=2024-05/Insta_insights.parquet
+# Readers take both folders as one Hive partitioned dataset, a day partition wins from its compacted month.
+# load_insights does that in Python; Insta_merge_files uses it with ?export=true to rebuild Insta_insights.csv
+# for the readers of the bulk file.
+PARTITION_FOLDER = 'partitions'
+COMPACTED_FOLDER = 'compacted'
+PARTITION_FILENAME = 'Insta_insights.csv'
+COMPACTED_FILENAME = 'Insta_insights.parquet'
+
+# Months are compacted once their last day is this many days old, later reruns of Insta_insights
+# for those days still land in a day partition and win from the compacted month
+COMPACT_AFTER_DAYS = int(os.getenv('INSTA_COMPACT_AFTER_DAYS', 7))
+
+# Partition uploads at the same time
+MAX_CONCURRENT_UPLOADS = 8
+
+
+def partition_folder(folder, date):
+    return f'{folder}/{PARTITION_FOLDER}/date={date}'
+
+
+def month_folder(folder, month):
+    return f'{folder}/{COMPACTED_FOLDER}/month={month}'
+
+
+def write_day_partitions(account_name, account_key, container_name, folder, df):
+    """Overwrite the day partition of every date in ``df``, a frame with a ``date`` column (YYYY-MM-DD)."""
+    def store(day):
+        date, rows = day
+        csv_buffer = StringIO()
+        rows.to_csv(csv_buffer, index=False, sep=';')
+        store_in_dls(account_name, account_key, container_name, partition_folder(folder, date), PARTITION_FILENAME,
+                     csv_buffer.getvalue())
+        return date
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS) as executor:
+        dates = list(executor.map(store, df.groupby('date', sort=True)))
+    logger.info(f'Stored {len(dates)} day partitions in {folder}')
+    return dates
+
+
+def list_partitions(account_name, account_key, container_name, folder, key):
+    """Values of the Hive style partition ``key`` below ``folder``, e.g. the dates of the day partitions."""
+    names = list_in_dls(account_name, account_key, container_name, f'{folder}/{key}=')
+    return sorted({name[len(folder) + 1:].split('/')[0].split('=', 1)[1] for name in names})
+
+
+def read_day_partition(account_name, account_key, container_name, folder, date):
+    content = download_from_dls(account_name, account_key, container_name, partition_folder(folder, date), PARTITION_FILENAME)
+    return pd.read_csv(BytesIO(content), sep=';', dtype={'date': str})
+
+
+def read_month(account_name, account_key, container_name, folder, month):
+    content = download_from_dls(account_name, account_key, container_name, month_folder(folder, month), COMPACTED_FILENAME)
+    return pd.read_parquet(BytesIO(content), engine='pyarrow')
+
+
+def compactable_months(dates, today, after_days=COMPACT_AFTER_DAYS):
+    """Months of the day partitions ``dates`` whose last day is at least ``after_days`` before ``today``."""
+    months = set()
+    for month in {date[:7] for date in dates}:
+        year, number = map(int, month.split('-'))
+        last_day = datetime.date(year, number, calendar.monthrange(year, number)[1])
+        if (today - last_day).days >= after_days:
+            months.add(month)
+    return sorted(months)
+
+
+def compact_month(account_name, account_key, container_name, folder, month, dates, compacted_months):
+    """Roll the day partitions ``dates`` of ``month`` into its Parquet file and remove them.
+
+    A day partition replaces the same date in an earlier compacted file. The partitions are only
+    removed after the Parquet file is stored, so a failed run leaves the data readable.
+    """
+    frames = [read_day_partition(account_name, account_key, container_name, folder, date) for date in dates]
+    if month in compacted_months:
+        frames.insert(0, read_month(account_name, account_key, container_name, folder, month))
+    df = (pd.concat(frames, ignore_index=True)
+          .drop_duplicates(subset=['date'], keep='last')
+          .sort_values('date', ignore_index=True))
+
+    buffer = BytesIO()
+    df.to_parquet(buffer, engine='pyarrow', compression='zstd', index=False)
+    store_in_dls(account_name, account_key, container_name, month_folder(folder, month), COMPACTED_FILENAME, buffer.getvalue())
+
+    delete_many_in_dls(account_name, account_key, container_name,
+                       [f'{partition_folder(folder, date)}/{PARTITION_FILENAME}' for date in dates])
+    logger.info(f'Compacted {len(dates)} days into {month_folder(folder, month)}/{COMPACTED_FILENAME}')
+    return len(df)
+
+
+def compact(account_name, account_key, container_name, folder, today=None):
+    """Compact every month of the store in ``folder`` that is old enough, returns the compacted months."""
+    today = today or datetime.datetime.now(datetime.timezone.utc).date()
+    dates = list_partitions(account_name, account_key, container_name, f'{folder}/{PARTITION_FOLDER}', 'date')
+    compacted_months = set(list_partitions(account_name, account_key, container_name, f'{folder}/{COMPACTED_FOLDER}', 'month'))
+    months = compactable_months(dates, today)
+    for month in months:
+        compact_month(account_name, account_key, container_name, folder, month,
+                      [date for date in dates if date.startswith(month)], compacted_months)
+    return months
+
+
+def load_insights(account_name, account_key, container_name, folder):
+    """The full history of the store in ``folder`` as one frame, a day partition wins from a compacted month."""
+    months = list_partitions(account_name, account_key, container_name, f'{folder}/{COMPACTED_FOLDER}', 'month')
+    dates = list_partitions(account_name, account_key, container_name, f'{folder}/{PARTITION_FOLDER}', 'date')
+    frames = [read_month(account_name, account_key, container_name, folder, month) for month in months]
+    frames += [read_day_partition(account_name, account_key, container_name, folder, date) for date in dates]
+    if not frames:
+        return None
+    return (pd.concat(frames, ignore_index=True)
+            .drop_duplicates(subset=['date'], keep='last')
+            .sort_values('date', ignore_index=True))
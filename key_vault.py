@@ -0,0 +1,91 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from get_secret import get_secret as get_env_secret
+
+logger = logging.getLogger(__name__)
+
+KEY_VAULT_URL = os.getenv('KEY_VAULT_URL', 'https://kv-cd-databrein-d1.vault.azure.net/')
+
+# Seconds a secret is served from memory before it is read from Key Vault again
+SECRET_TTL = int(os.getenv('KEY_VAULT_SECRET_TTL', 3600))
+# Concurrent Key Vault requests of a prefetch
+MAX_CONCURRENT_FETCHES = 8
+
+# The client and the secrets stay in memory for the life of the worker: secret name -> (value, expires_at)
+_client = None
+_cache = {}
+_lock = threading.Lock()
+
+
+def get_client():
+    """Shared ``SecretClient``, created on first use. ``None`` when no service principal is configured,
+    e.g. on a local run, in which case the secrets are read from the environment.
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            tenant_id = os.getenv('AR_TENANT_ID')
+            client_id = os.getenv('AR_CLIENT_ID')
+            client_secret = os.getenv('AR_APP_SECRET')
+            if not (tenant_id and client_id and client_secret):
+                return None
+
+            from azure.identity import ClientSecretCredential
+            from azure.keyvault.secrets import SecretClient
+
+            credential = ClientSecretCredential(tenant_id, client_id, client_secret)
+            _client = SecretClient(vault_url=KEY_VAULT_URL, credential=credential)
+            logger.info(f"Initialized SecretClient for {KEY_VAULT_URL}")
+        return _client
+
+
+def _fetch_secret(secret_name):
+    client = get_client()
+    if client is None:
+        return get_env_secret(secret_name)
+
+    try:
+        return client.get_secret(secret_name).value
+    except Exception:
+        # Keep working on a Key Vault hiccup when the secret is also set in the app settings
+        value = get_env_secret(secret_name)
+        if value is None:
+            raise
+        logger.warning(f"Key Vault lookup of {secret_name} failed, using the environment value")
+        return value
+
+
+def _cached(secret_name):
+    entry = _cache.get(secret_name)
+    if entry is not None and entry[1] > time.monotonic():
+        return entry[0]
+    return None
+
+
+def _store(secret_name, value):
+    _cache[secret_name] = (value, time.monotonic() + SECRET_TTL)
+
+
+def prefetch_secrets(secret_names):
+    """Read all secrets that are missing or expired from Key Vault concurrently and cache them."""
+    missing = [name for name in dict.fromkeys(secret_names) if _cached(name) is None]
+    if not missing:
+        return
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_FETCHES, len(missing))) as executor:
+        for name, value in zip(missing, executor.map(_fetch_secret, missing)):
+            _store(name, value)
+    logger.info(f"Fetched {len(missing)} secrets in {time.perf_counter() - start:.2f}s")
+
+
+def get_secret(secret_name):
+    """Value of a secret, from the in-memory cache while it is fresh and from Key Vault otherwise."""
+    value = _cached(secret_name)
+    if value is None:
+        value = _fetch_secret(secret_name)
+        _store(secret_name, value)
+    return value
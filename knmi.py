@@ -0,0 +1,295 @@
+import logging
+import os
+from io import BytesIO
+import http_client
+from lazy_import import lazy_import
+
+nc = lazy_import('netCDF4')
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+pq = lazy_import('pyarrow.parquet')
+pa = lazy_import('pyarrow')
+
+logger = logging.getLogger(__name__)
+
+# Reference date of the KNMI time axis
+REFERENCE_DATE = '1950-01-01'
+
+# Variables that describe the grid rather than observations
+EXCLUDED_VARS = {'station', 'time', 'lat', 'lon', 'iso_dataset', 'product', 'projection'}
+
+# De Bilt, the station that is read when no stations are requested
+DE_BILT_CODE = '260'
+
+# Partition value used by Hive style partitioning for missing keys
+PARTITION_DEFAULT = '__HIVE_DEFAULT_PARTITION__'
+
+# Memory the chunked reader may use for one window of observations
+MEMORY_BUDGET = int(os.environ.get("KNMI_MEMORY_BUDGET_MB", 256)) * 1024 * 1024
+# Rough peak bytes per observation value while reading a window: masked array, float copy and frame column
+BYTES_PER_VALUE = 32
+
+class OpenDataAPI:
+    def __init__(self, api_token: str):
+        self.base_url = "https://api.dataplatform.knmi.nl/open-data/v1"
+        self.headers = {"Authorization": api_token}
+
+    def __get_data(self, url, params=None):
+        return http_client.get(url, headers=self.headers, params=params).json()
+
+    def list_files(self, dataset_name: str, dataset_version: str, params: dict):
+        return self.__get_data(
+            f"{self.base_url}/datasets/{dataset_name}/versions/{dataset_version}/files",
+            params=params,
+        )
+
+    def get_file_url(self, dataset_name: str, dataset_version: str, file_name: str):
+        return self.__get_data(
+            f"{self.base_url}/datasets/{dataset_name}/versions/{dataset_version}/files/{file_name}/url"
+        )
+
+    def iter_files(self, dataset_name: str, dataset_version: str, params: dict):
+        """Yield every file of the listing, following the ``nextPageToken`` until the last page."""
+        params = dict(params)
+        while True:
+            response = self.list_files(dataset_name, dataset_version, params)
+            if "error" in response:
+                raise RuntimeError(f"Unable to retrieve list of files: {response['error']}")
+
+            yield from response.get("files", [])
+
+            if not response.get("isTruncated") or not response.get("nextPageToken"):
+                break
+            params["nextPageToken"] = response["nextPageToken"]
+
+
+def open_dataset(source):
+    """Open a NetCDF dataset from a local file path or from bytes that are already in memory.
+
+    In-memory sources (``bytes``, ``bytearray`` or a ``memoryview`` such as ``BytesIO.getbuffer()``)
+    are handed to netCDF4 as they are, so the file is not copied again.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return nc.Dataset(source, 'r')
+    return nc.Dataset('inmemory.nc', 'r', memory=source)
+
+
+def to_float_array(values, fill_value=None):
+    """Turn a (masked) NetCDF slice into a float array with NaN for masked and ``_FillValue`` entries."""
+    values = np.ma.asarray(values)
+    if values.dtype.kind not in 'biuf':
+        return np.ma.filled(values.astype(object), None)
+
+    array = np.ma.filled(values.astype('float64'), np.nan)
+    if fill_value is not None:
+        array[array == fill_value] = np.nan
+    return array
+
+
+def convert_time_axis(time_var, start=None, stop=None):
+    """Convert the time axis, or its ``start:stop`` window, to datetimes in one array operation.
+
+    Masked and ``_FillValue`` entries become NaT.
+    """
+    offsets = to_float_array(time_var[start:stop], getattr(time_var, '_FillValue', None))
+    time_units = time_var.units
+
+    if time_units.startswith('days since'):
+        return pd.Timestamp(REFERENCE_DATE) + pd.to_timedelta(offsets - 1, unit='D')
+    elif time_units.startswith('seconds since'):
+        return pd.Timestamp(REFERENCE_DATE) + pd.to_timedelta(offsets, unit='s')
+    else:
+        raise ValueError("Unsupported time units. Supported units are 'days since' or 'seconds since'.")
+
+
+def observation_variables(dataset):
+    """Names of the (station, time) observation variables in the dataset."""
+    return [name for name, var in dataset.variables.items()
+            if name not in EXCLUDED_VARS and var.ndim == 2]
+
+
+def parse_list_param(value):
+    """Split a comma separated query parameter into a list, ``None`` when it is empty."""
+    if not value:
+        return None
+    items = [item.strip() for item in value.split(',') if item.strip()]
+    return items or None
+
+
+def station_number(code):
+    """KNMI station number of a station code, ``06260`` and ``260`` both give ``260``."""
+    code = str(code).strip()
+    if len(code) == 5 and code.startswith('06'):
+        return code[2:]
+    return code
+
+
+def station_codes(dataset):
+    """KNMI station numbers of all stations in the dataset, in file order."""
+    return [station_number(code) for code in dataset.variables['station'][:]]
+
+
+def station_index(dataset):
+    """Map every station code in the dataset to its position along the station dimension.
+
+    The files use WMO ids (``06260``) while we refer to stations by their KNMI number (``260``),
+    so both are accepted. The index is built from every file itself, a republished file can list
+    other stations under the same name.
+    """
+    index = {}
+    for position, code in enumerate(dataset.variables['station'][:]):
+        code = str(code).strip()
+        index[code] = position
+        index[station_number(code)] = position
+    return index
+
+
+def select(dataset, stations=None, variables=None):
+    """Resolve the requested stations and variables to array positions, KNMI station numbers and variable names.
+
+    Without stations only De Bilt is selected, without variables every observation variable.
+    Unknown stations or variables raise a ``KeyError``.
+    """
+    if 'time' not in dataset.variables:
+        raise ValueError("'time' variable not found in the NetCDF dataset.")
+
+    stations = stations or [DE_BILT_CODE]
+    available_variables = observation_variables(dataset)
+    variables = variables or available_variables
+
+    index = station_index(dataset)
+    unknown_stations = [code for code in stations if code not in index]
+    if unknown_stations:
+        raise KeyError(f"Unknown station codes: {', '.join(unknown_stations)}")
+    unknown_variables = [name for name in variables if name not in available_variables]
+    if unknown_variables:
+        raise KeyError(f"Unknown variables: {', '.join(unknown_variables)}")
+
+    # Read the stations in file order, netCDF4 turns the sorted positions into strided reads
+    selection = sorted({index[code]: station_number(code) for code in stations}.items())
+    positions = [position for position, _ in selection]
+    codes = [code for _, code in selection]
+    return positions, codes, variables
+
+
+def normalize_window(dataset, positions, codes, variables, start, stop, daily=True):
+    """Normalize the time steps ``start:stop`` of the selected stations and variables."""
+    times = convert_time_axis(dataset.variables['time'], start, stop)
+    if daily:
+        times = times - pd.Timedelta(days=1)
+
+    columns = {
+        'Station': np.repeat(np.array(codes, dtype=object), len(times)),
+        'Time': np.tile(times.values, len(codes)),
+    }
+    for var_name in variables:
+        var = dataset.variables[var_name]
+        values = to_float_array(var[positions, start:stop], getattr(var, '_FillValue', None))
+        columns[var.long_name] = values.reshape(-1)
+
+    return pd.DataFrame(columns)
+
+
+def window_size(n_stations, n_variables, memory_budget=MEMORY_BUDGET):
+    """Number of time steps whose observations fit in the memory budget, at least one."""
+    bytes_per_step = n_stations * (n_variables * BYTES_PER_VALUE + 2 * BYTES_PER_VALUE)
+    return max(1, memory_budget // bytes_per_step)
+
+
+def iter_normalized_chunks(dataset, stations=None, variables=None, daily=True, memory_budget=MEMORY_BUDGET):
+    """Normalize the dataset in windows along the time dimension that fit the memory budget.
+
+    The selection is validated right away, the returned generator then reads one window at a time
+    and yields its long-format frame (see ``normalize_dataset``), so peak memory depends on the
+    budget rather than on the length of the file.
+    """
+    positions, codes, variables = select(dataset, stations, variables)
+    n_times = len(dataset.dimensions[dataset.variables['time'].dimensions[0]])
+    window = window_size(len(positions), len(variables), memory_budget)
+
+    def windows():
+        for start in range(0, n_times, window):
+            yield normalize_window(dataset, positions, codes, variables, start, min(start + window, n_times), daily)
+
+    return windows()
+
+
+def normalize_dataset(dataset, stations=None, variables=None, daily=True):
+    """Build the normalized long-format frame of the requested stations and variables.
+
+    The frame has one row per station and time step with the columns ``Station``, ``Time`` and the
+    long name of every requested observation variable. Daily values are stamped at the end of the
+    day, so with ``daily`` the ``Time`` is shifted back to the day the observation belongs to.
+    Only the hyperslabs of the requested stations are read from the file, so the work grows with
+    the selection rather than with the file size. Unknown stations or variables raise a ``KeyError``.
+    """
+    positions, codes, variables = select(dataset, stations, variables)
+    n_times = len(dataset.dimensions[dataset.variables['time'].dimensions[0]])
+    return normalize_window(dataset, positions, codes, variables, 0, n_times, daily)
+
+
+def normalize_file(path, stations=None, variables=None, daily=True, memory_budget=MEMORY_BUDGET):
+    """Normalize a local NetCDF file into a local Parquet file next to it, the worker of the backfill process pool.
+
+    The file is read in windows that fit ``memory_budget`` (see ``iter_normalized_chunks``) and every
+    window is written as its own row group, so neither the worker nor the reader of the Parquet file
+    (``read_parquet_chunks``) holds more than one window. Returns the path of the Parquet file,
+    ``None`` when the file has no time steps.
+    """
+    parquet_path = f"{path}.parquet"
+    writer = None
+    try:
+        with open_dataset(path) as dataset:
+            for chunk in iter_normalized_chunks(dataset, stations, variables, daily, memory_budget):
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(parquet_path, table.schema)
+                writer.write_table(table)
+    except Exception:
+        if writer is not None:
+            writer.close()
+            os.remove(parquet_path)
+        raise
+    if writer is None:
+        return None
+    writer.close()
+    return parquet_path
+
+
+def read_parquet_chunks(path):
+    """Yield the row groups of a Parquet file written by ``normalize_file`` as frames, one at a time."""
+    parquet_file = pq.ParquetFile(path)
+    for i in range(parquet_file.num_row_groups):
+        yield parquet_file.read_row_group(i).to_pandas()
+
+
+def partition_value(value):
+    """Format a partition key for a Hive style path, missing keys get the default partition."""
+    if pd.isna(value):
+        return PARTITION_DEFAULT
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def parquet_partitions(df, part_name, partition_by=('Station', 'Year'), compression='zstd'):
+    """Split the frame into Hive style partitions and serialize each one to Parquet.
+
+    ``partition_by`` holds columns of the frame or ``Year``/``Date``, which are derived from ``Time``.
+    Yields ``(partition_path, parquet_bytes)``, e.g. ``Station=260/Year=2024/<part_name>.parquet``.
+    Every call produces a new part file per partition, so appending adds files to the affected
+    partitions instead of rewriting the history. The partition columns are encoded in the path and
+    left out of the files, as Hive partitioning does.
+    """
+    derived = {
+        'Year': df['Time'].dt.year,
+        'Date': df['Time'].dt.strftime('%Y-%m-%d'),
+    }
+    keys = [df[name] if name in df.columns else derived[name].rename(name) for name in partition_by]
+    stored_columns = [name for name in partition_by if name in df.columns]
+
+    for values, part in df.groupby(keys, dropna=False, sort=True):
+        path = "/".join(f"{name}={partition_value(value)}" for name, value in zip(partition_by, values))
+        buffer = BytesIO()
+        part.drop(columns=stored_columns).to_parquet(buffer, engine='pyarrow', compression=compression, index=False)
+        yield f"{path}/{part_name}.parquet", buffer.getvalue()
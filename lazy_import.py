@@ -0,0 +1,33 @@
+import importlib
+import os
+import types
+
+# Heavy dependencies are loaded on first use, so a cold start only pays for what the request needs.
+# Set LAZY_IMPORTS=false to load them at import time again, e.g. to compare in benchmarks/cold_start.py
+LAZY_IMPORTS = os.getenv('LAZY_IMPORTS', 'true').lower() != 'false'
+
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module that imports it on the first attribute access.
+
+    The stand-in is not put in ``sys.modules``, so an ordinary ``import`` elsewhere still gets the
+    real module, and the import lock of the import system makes a first use from several threads safe.
+    """
+
+    def __getattr__(self, attr):
+        module = self.__dict__.get('_module')
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_module'] = module
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """Module ``name``, only imported when one of its attributes is first used.
+
+    Meant for ``pd = lazy_import('pandas')`` style imports, ``from module import name`` needs the
+    module right away and stays an ordinary import inside the function that uses it.
+    """
+    if not LAZY_IMPORTS:
+        return importlib.import_module(name)
+    return LazyModule(name)
@@ -0,0 +1,445 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import http_client
+
+logger = logging.getLogger(__name__)
+
+# One Graph API version for every Instagram function
+GRAPH_API_VERSION = os.getenv('META_GRAPH_API_VERSION', 'v20.0')
+GRAPH_URL = 'https://graph.facebook.com'
+
+# The batch endpoint takes at most 50 requests per call
+BATCH_SIZE = 50
+# Batch calls sent at the same time, each one already holds up to 50 requests
+MAX_CONCURRENT_BATCHES = 4
+
+# Graph error code of a page that asks for too much data, the page limit is halved and the page retried
+REDUCE_DATA_ERROR_CODE = 1
+
+# Calls per hour each Instagram account may make, kept below the Business Use Case limit of the account
+ACCOUNT_CALLS_PER_HOUR = int(os.getenv('META_ACCOUNT_CALLS_PER_HOUR', 1000))
+# Longest a call waits for budget before the account gives up for this run
+MAX_BUDGET_WAIT = float(os.getenv('META_MAX_BUDGET_WAIT', 60))
+
+# Key Vault secret of the page token used when an account does not name its own
+DEFAULT_TOKEN_SECRET = 'Meta-Page-Token'
+# Accounts handled at the same time by the Insta functions
+MAX_CONCURRENT_ACCOUNTS = int(os.getenv('INSTA_MAX_CONCURRENT_ACCOUNTS', 4))
+
+# Utilization in percent of the quotas Meta reports (X-App-Usage, X-Business-Use-Case-Usage) that calls
+# are scheduled to stay under. From half the target on, calls are spaced out and fewer run at once,
+# at the target they pause until the usage has come down, before Meta blocks the app or the account.
+TARGET_UTILIZATION = float(os.getenv('META_TARGET_UTILIZATION', 75))
+MAX_CONCURRENT_CALLS = int(os.getenv('META_MAX_CONCURRENT_CALLS', 8))
+# Seconds between calls just below the target
+MAX_CALL_SPACING = float(os.getenv('META_MAX_CALL_SPACING', 5))
+# Pause at the target when Meta gives no estimate of when access is regained
+COOLDOWN = float(os.getenv('META_COOLDOWN', 60))
+# Longest a call waits for a pause to end before the account gives up for this run
+MAX_PAUSE = float(os.getenv('META_MAX_PAUSE', 300))
+# Retries of a call that was throttled anyway, each one after a pause
+THROTTLE_RETRIES = 3
+
+# Graph error codes of the app rate limit, and of the user, page, custom and Business Use Case rate limits
+# that follow the token or the account of the call
+APP_THROTTLE_CODES = frozenset({4})
+ACCOUNT_THROTTLE_CODES = frozenset({17, 32, 613, 80001, 80002})
+THROTTLE_ERROR_CODES = APP_THROTTLE_CODES | ACCOUNT_THROTTLE_CODES
+# Statuses http_client retries for Graph calls, a 429 goes back to the governors so they pause first
+GRAPH_RETRY_STATUSES = http_client.RETRY_STATUSES - {429}
+
+
+class GraphAPIError(Exception):
+    def __init__(self, error):
+        self.code = error.get('code')
+        self.message = error.get('message', '')
+        super().__init__(f"Graph API error {self.code}: {self.message}")
+
+
+class RateBudgetExceeded(Exception):
+    pass
+
+
+class RateBudget:
+    """Token bucket of Graph calls for one account, refilled continuously up to ``calls_per_hour``."""
+
+    def __init__(self, name, calls_per_hour=ACCOUNT_CALLS_PER_HOUR, max_wait=MAX_BUDGET_WAIT):
+        self.name = name
+        self.capacity = calls_per_hour
+        self.rate = calls_per_hour / 3600
+        self.max_wait = max_wait
+        self.tokens = float(calls_per_hour)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, calls=1):
+        """Take ``calls`` from the budget, waiting for the refill when it is used up."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= calls:
+                    self.tokens -= calls
+                    return
+                wait = (calls - self.tokens) / self.rate
+
+            if waited + wait > self.max_wait:
+                raise RateBudgetExceeded(f"Rate budget of {self.name} is used up for the next {wait:.0f}s")
+            time.sleep(wait)
+            waited += wait
+
+
+# One budget per account for the life of the worker, shared by every function that calls for the account
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+
+class UsageGovernor:
+    """Limits concurrency and spacing of Graph calls from the usage Meta reports for one quota."""
+
+    def __init__(self, name, target=TARGET_UTILIZATION, max_concurrency=MAX_CONCURRENT_CALLS):
+        self.name = name
+        self.target = target
+        self.max_concurrency = max_concurrency
+        self.utilization = 0.0
+        self.paused_until = 0.0
+        self.last_call = 0.0
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def limits(self):
+        """Allowed concurrent calls and seconds between calls at the current utilization."""
+        load = self.utilization / self.target
+        if load < 0.5:
+            return self.max_concurrency, 0.0
+        scale = min(1.0, (load - 0.5) / 0.5)
+        return max(1, round(self.max_concurrency * (1 - scale))), MAX_CALL_SPACING * scale
+
+    def acquire(self, max_wait=MAX_PAUSE):
+        deadline = time.monotonic() + max_wait
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                concurrency, spacing = self.limits()
+                ready_at = max(self.paused_until, self.last_call + spacing)
+                if self.active < concurrency and ready_at <= now:
+                    self.active += 1
+                    self.last_call = now
+                    return
+                if ready_at > deadline:
+                    raise RateBudgetExceeded(f"Graph usage of {self.name} is at {self.utilization:.0f}%, "
+                                             f"calls are paused for {ready_at - now:.0f}s")
+                if now >= deadline:
+                    raise RateBudgetExceeded(f"No free call slot for {self.name} within {max_wait:.0f}s")
+                # Woken early by a released slot or a usage update
+                self.condition.wait(timeout=min(max(ready_at - now, 0.05), deadline - now))
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def update(self, utilization, regain_seconds=0):
+        """Record the reported utilization, at the target the calls pause for a cooldown."""
+        with self.condition:
+            self.utilization = utilization
+            if utilization >= self.target:
+                pause = max(regain_seconds, COOLDOWN)
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+                logger.warning(f"Graph usage of {self.name} is at {utilization:.0f}%, pausing calls for {pause:.0f}s")
+            self.condition.notify_all()
+
+
+# The app quota is shared by every call, the Business Use Case quota is per account
+_app_governor = UsageGovernor('the app')
+_governors = {}
+
+
+def account_governor(account_id):
+    with _budgets_lock:
+        if account_id not in _governors:
+            _governors[account_id] = UsageGovernor(f'account {account_id}')
+        return _governors[account_id]
+
+
+def parse_usage(headers):
+    """App utilization and the highest Business Use Case utilization in percent, with the seconds
+    until the Business Use Case quota is regained."""
+    app_usage = json.loads(headers.get('X-App-Usage') or '{}')
+    app = max([value for value in app_usage.values() if isinstance(value, (int, float))], default=0)
+
+    business, regain_seconds = 0, 0
+    for entries in json.loads(headers.get('X-Business-Use-Case-Usage') or '{}').values():
+        for entry in entries:
+            business = max(business, entry.get('call_count', 0), entry.get('total_cputime', 0), entry.get('total_time', 0))
+            regain_seconds = max(regain_seconds, entry.get('estimated_time_to_regain_access', 0) * 60)
+    return app, business, regain_seconds
+
+
+def throttled_quota(response):
+    """``'app'`` or ``'account'``, the quota a throttled response ran into, ``None`` when it was not throttled.
+
+    A 429 without a rate limit error code is taken as the quota of the account.
+    """
+    try:
+        error = response.json().get('error')
+    except (ValueError, AttributeError):
+        error = None
+    code = error.get('code') if error else None
+    if code in APP_THROTTLE_CODES:
+        return 'app'
+    if code in ACCOUNT_THROTTLE_CODES or response.status_code == 429:
+        return 'account'
+    return None
+
+
+def is_throttled(response):
+    return throttled_quota(response) is not None
+
+
+def account_budget(account_id):
+    with _budgets_lock:
+        if account_id not in _budgets:
+            _budgets[account_id] = RateBudget(account_id)
+        return _budgets[account_id]
+
+
+def instagram_accounts():
+    """The Instagram business accounts to ingest as ``(account_id, token_secret_name)`` pairs.
+
+    ``IG_ACCOUNTS`` lists them as ``id`` or ``id:secret-name``, an account without a secret name uses
+    the shared page token. Without ``IG_ACCOUNTS`` the single ``IG_BUSINESS_ACCOUNT_ID`` is used.
+    """
+    accounts = []
+    for item in os.getenv('IG_ACCOUNTS', '').split(','):
+        if item.strip():
+            account_id, _, secret_name = item.strip().partition(':')
+            accounts.append((account_id.strip(), secret_name.strip() or DEFAULT_TOKEN_SECRET))
+    if not accounts and os.getenv('IG_BUSINESS_ACCOUNT_ID'):
+        accounts.append((os.getenv('IG_BUSINESS_ACCOUNT_ID'), DEFAULT_TOKEN_SECRET))
+    return accounts
+
+
+def is_multi_account():
+    """True when ``IG_ACCOUNTS`` is set, the outputs are then partitioned by account."""
+    return bool(os.getenv('IG_ACCOUNTS', '').strip())
+
+
+def account_folder(folder_name, account_id):
+    """Folder of an account, several accounts are stored as one dataset with a partition per account."""
+    if is_multi_account():
+        return f'{folder_name}/account_id={account_id}'
+    return folder_name
+
+
+def account_folders(folder_name):
+    """Folders of all configured accounts below ``folder_name``."""
+    if not is_multi_account():
+        return [folder_name]
+    return [account_folder(folder_name, account_id) for account_id, _ in instagram_accounts()]
+
+
+def for_each_account(accounts, work, max_workers=MAX_CONCURRENT_ACCOUNTS):
+    """Run ``work(account_id, token_secret_name)`` for every account at the same time.
+
+    The accounts share the HTTP pools and each stays within its own rate budget. An account that runs
+    out of it or fails otherwise, e.g. on an expired token, is skipped and the other accounts go on.
+    Returns the results, ``None`` for skipped accounts, and the error of every skipped account by id.
+    """
+    errors = {}
+
+    def run(account):
+        try:
+            return work(*account)
+        except RateBudgetExceeded as e:
+            logger.error(f'Skipped account {account[0]}: {e}')
+            errors[account[0]] = e
+        except Exception as e:
+            logger.exception(f'Skipped account {account[0]} after an error')
+            errors[account[0]] = e
+        return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(run, accounts))
+    return results, {account_id: errors[account_id] for account_id, _ in accounts if account_id in errors}
+
+
+def accounts_summary(accounts, skipped, message):
+    """Response message and status code of a run over ``accounts`` with the errors of the ``skipped`` ones.
+
+    200 when every account was processed, 207 when some were skipped, and when all were skipped 429
+    if they all ran out of rate budget and 500 otherwise.
+    """
+    reasons = '; '.join(f'{account_id}: {error}' for account_id, error in skipped.items())
+    if len(skipped) == len(accounts):
+        budget_only = all(isinstance(error, RateBudgetExceeded) for error in skipped.values())
+        return f'No account could be processed, skipped {reasons}', 429 if budget_only else 500
+    message = f'{message} for {len(accounts) - len(skipped)} accounts'
+    if skipped:
+        return f'{message}, skipped {reasons}', 207
+    return message, 200
+
+
+def graph_url(path=''):
+    return f"{GRAPH_URL}/{GRAPH_API_VERSION}/{path.lstrip('/')}"
+
+
+def request(method, url, budget=None, calls=1, **kwargs):
+    """Send a Graph call when the quotas allow it and return the response.
+
+    The call waits for the rate ``budget`` of the account and for a slot of the app and account
+    governors, which follow the usage headers of every response. A call that is throttled anyway
+    pauses the governor of the quota it ran into and is retried after the pause. A 429 is not retried
+    by http_client, so the pause comes before more calls are sent. A response from the HTTP cache
+    costs no call.
+    """
+    response = http_client.request(method, url, cache_only=True, **kwargs)
+    if response is not None:
+        return response
+
+    governors = [_app_governor]
+    if budget is not None:
+        governors.insert(0, account_governor(budget.name))
+
+    for attempt in range(THROTTLE_RETRIES + 1):
+        if budget is not None:
+            budget.acquire(calls)
+        acquired = []
+        try:
+            for governor in governors:
+                governor.acquire()
+                acquired.append(governor)
+            response = http_client.request(method, url, retry_statuses=GRAPH_RETRY_STATUSES, **kwargs)
+        finally:
+            for governor in acquired:
+                governor.release()
+        if getattr(response, 'from_cache', False):
+            return response
+
+        app, business, regain_seconds = parse_usage(response.headers)
+        quota = throttled_quota(response)
+        throttled = quota is not None
+        # Blocked although the reported usage was below the target, pause that quota as if it had been reached
+        if quota == 'app' or (throttled and budget is None):
+            app = max(app, _app_governor.target)
+        elif throttled:
+            business = max(business, governors[0].target)
+        _app_governor.update(app)
+        if budget is not None:
+            governors[0].update(business, regain_seconds)
+
+        if not throttled or attempt == THROTTLE_RETRIES:
+            return response
+        logger.warning(f"{method} {url.split('?')[0]} was throttled, retry {attempt + 1} of {THROTTLE_RETRIES} after the pause")
+
+
+def get(url, params=None, budget=None):
+    """JSON of a Graph call, a Graph error payload is raised as ``GraphAPIError``.
+
+    With a ``budget`` the call is taken from the rate budget of the account first.
+    """
+    data = request('GET', url, budget, params=params).json()
+    if 'error' in data:
+        raise GraphAPIError(data['error'])
+    return data
+
+
+def with_query(url, **params):
+    """``url`` with the query parameters ``params`` set."""
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    query.update(params)
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def with_limit(url, limit):
+    """``url`` with its ``limit`` query parameter set to ``limit``."""
+    return with_query(url, limit=limit)
+
+
+def without_access_token(url):
+    """``url`` without its ``access_token``, so a paging link can be stored."""
+    parts = urlsplit(url)
+    query = [(name, value) for name, value in parse_qsl(parts.query) if name != 'access_token']
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def pages(path, params, access_token, budget=None, resume_url=None):
+    """Yield the items of every page of an edge with the link of the next page, following ``paging.next``.
+
+    The next link is yielded without the access token, so it can be stored in a checkpoint and passed
+    back as ``resume_url`` to continue the listing there. It is ``None`` on the last page.
+    Pages that are too large for the API (error code 1) are retried with half the ``limit``.
+    """
+    if resume_url is not None:
+        url = with_query(resume_url, access_token=access_token)
+        page_params = None
+    else:
+        url = graph_url(path)
+        page_params = dict(params, access_token=access_token)
+    while url:
+        try:
+            data = get(url, page_params, budget)
+        except GraphAPIError as e:
+            limit = int((page_params or dict(parse_qsl(urlsplit(url).query))).get('limit', 0))
+            if e.code != REDUCE_DATA_ERROR_CODE or limit <= 1:
+                raise
+            logger.warning(f"Page of {path} is too large, retrying with limit {limit // 2}")
+            if page_params is not None:
+                page_params['limit'] = limit // 2
+            else:
+                url = with_limit(url, limit // 2)
+            continue
+
+        # The next link holds the other parameters, the access token is set again because the HTTP cache
+        # stores the links without it
+        next_url = data.get('paging', {}).get('next')
+        url = with_query(next_url, access_token=access_token) if next_url else None
+        page_params = None
+        yield data.get('data', []), without_access_token(next_url) if next_url else None
+
+
+def batch(relative_urls, access_token, budget=None):
+    """GET every relative url through the batch endpoint, 50 per call.
+
+    Returns the parsed bodies in the order of ``relative_urls``, ``None`` for requests that failed.
+    Every request in a batch counts as a call against the ``budget``.
+    """
+    chunks = [relative_urls[i:i + BATCH_SIZE] for i in range(0, len(relative_urls), BATCH_SIZE)]
+
+    def send(chunk):
+        calls = [{'method': 'GET', 'relative_url': relative_url} for relative_url in chunk]
+        response = request('POST', graph_url(), budget, calls=len(calls),
+                           data={'access_token': access_token, 'include_headers': 'false', 'batch': json.dumps(calls)})
+        results = response.json()
+        if isinstance(results, dict) and 'error' in results:
+            raise GraphAPIError(results['error'])
+
+        bodies = []
+        for relative_url, result in zip(chunk, results):
+            # A request of the batch that timed out comes back as null
+            body = json.loads(result['body']) if result and result.get('body') else {}
+            if result is None or result.get('code') != 200 or 'error' in body:
+                error = body.get('error', {}).get('message', 'no response')
+                logger.warning(f"Batch request {relative_url.split('?')[0]} failed: {error}")
+                bodies.append(None)
+            else:
+                bodies.append(body)
+        return bodies
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_BATCHES) as executor:
+        futures = [executor.submit(send, chunk) for chunk in chunks]
+        try:
+            return [body for future in futures for body in future.result()]
+        except Exception:
+            # The batches that have not started are dropped, the failure ends the fetch anyway
+            for future in futures:
+                future.cancel()
+            raise
@@ -0,0 +1,188 @@
+import unittest
+from io import BytesIO
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pandas as pd
+
+from Download_KNMI_Report import compact_parquet, covers, empty_manifest, is_ingested, output_key, output_name, \
+    select_new_days, selection_key, store_parquet_in_dls, update_manifest, write_outputs
+
+FILE_INFO = {'filename': 'INTER_OPER_R___TX______L3__20240501.nc', 'size': 1024, 'created': '2024-05-02T00:10:00+00:00'}
+
+
+class TestSelectionKey(unittest.TestCase):
+
+    def test_station_codes_are_normalized(self):
+        self.assertEqual(selection_key(['06344', '260', '06260'], ['TX', 'TG']),
+                         {'stations': ['260', '344'], 'variables': ['TG', 'TX']})
+
+    def test_defaults_to_de_bilt_and_all_variables(self):
+        self.assertEqual(selection_key(None, None), {'stations': ['260'], 'variables': None})
+
+
+class TestCovers(unittest.TestCase):
+
+    def test_everything_covers_any_request(self):
+        self.assertTrue(covers(None, ['TX']))
+        self.assertTrue(covers(None, None))
+
+    def test_subset(self):
+        self.assertTrue(covers(['TG', 'TX'], ['TX']))
+        self.assertFalse(covers(['TX'], ['TG', 'TX']))
+
+    def test_list_does_not_cover_everything(self):
+        self.assertFalse(covers(['TG', 'TX'], None))
+
+
+class TestIsIngested(unittest.TestCase):
+
+    def setUp(self):
+        self.manifest = update_manifest(empty_manifest(), FILE_INFO, selection_key(['260', '344'], ['TX']),
+                                        ['csv', 'parquet'])
+
+    def test_same_file_selection_and_outputs(self):
+        self.assertTrue(is_ingested(self.manifest, FILE_INFO, selection_key(['260'], ['TX']), ['csv']))
+
+    def test_changed_file(self):
+        file_info = dict(FILE_INFO, size=2048)
+        self.assertFalse(is_ingested(self.manifest, file_info, selection_key(['260'], ['TX']), ['csv']))
+
+    def test_other_station_or_variable(self):
+        self.assertFalse(is_ingested(self.manifest, FILE_INFO, selection_key(['380'], ['TX']), ['csv']))
+        self.assertFalse(is_ingested(self.manifest, FILE_INFO, selection_key(['260'], ['TG']), ['csv']))
+        self.assertFalse(is_ingested(self.manifest, FILE_INFO, selection_key(['260'], None), ['csv']))
+
+    def test_other_output(self):
+        self.assertFalse(is_ingested(self.manifest, FILE_INFO, selection_key(['260'], ['TX']), ['csv', 'sql']))
+
+    def test_entry_without_selection_is_ingested_again(self):
+        manifest = {'files': [dict(FILE_INFO)], 'outputs': {}}
+        self.assertFalse(is_ingested(manifest, FILE_INFO, selection_key(['260'], ['TX']), ['csv']))
+
+
+class TestOutputName(unittest.TestCase):
+
+    def test_default_selection(self):
+        self.assertEqual(output_name(selection_key(None, None)), 'KNMI_Data_Daily')
+        self.assertEqual(output_name(selection_key(['06260'], None)), 'KNMI_Data_Daily')
+
+    def test_other_selections_get_their_own_output(self):
+        self.assertEqual(output_name(selection_key(['260', '240'], None)), 'KNMI_Data_Daily_240-260')
+        self.assertEqual(output_name(selection_key(['240'], ['TG'])), 'KNMI_Data_Daily_240_TG')
+
+
+@patch('Download_KNMI_Report.get_blob_client')
+class TestRebuild(unittest.TestCase):
+    """Runs of ``main`` reduced to the manifest check, ``write_outputs`` and the manifest update."""
+
+    def run_selection(self, manifest, stations, variables, incremental=True):
+        selection = selection_key(stations, variables)
+        name = output_name(selection)
+        keys = [output_key('csv', name)]
+        if incremental and is_ingested(manifest, FILE_INFO, selection, keys):
+            return False
+        columns = {variable: [1.0] for variable in variables or ['TG', 'TX']}
+        chunk = pd.DataFrame({'Station': selection['stations'][:1], 'Time': pd.to_datetime(['2024-05-01']), **columns})
+        write_outputs([chunk], ['csv'], 'account', 'key', 'container', f'{name}.csv', name,
+                      manifest=manifest, incremental=incremental, name=name)
+        update_manifest(manifest, FILE_INFO, selection, keys)
+        return True
+
+    def test_other_selection_does_not_replace_the_default_output(self, get_blob_client):
+        manifest = empty_manifest()
+        self.assertTrue(self.run_selection(manifest, None, None))
+        self.assertTrue(self.run_selection(manifest, ['240'], ['TG']))
+        self.assertFalse(self.run_selection(manifest, None, None))
+        self.assertEqual(get_blob_client.call_args_list[-1].args[-1], 'KNMI_Data_Daily_240_TG.csv')
+
+    def test_rebuilt_output_is_ingested_again(self, get_blob_client):
+        manifest = empty_manifest()
+        self.assertTrue(self.run_selection(manifest, None, None))
+        self.assertTrue(self.run_selection(manifest, None, None, incremental=False))
+        self.assertEqual(len(manifest['files']), 1)
+        self.assertFalse(self.run_selection(manifest, None, None))
+
+    def test_rebuild_forgets_the_files_written_before(self, get_blob_client):
+        manifest = update_manifest(empty_manifest(), FILE_INFO, selection_key(None, None), ['csv:KNMI_Data_Daily'])
+        manifest['outputs']['csv:KNMI_Data_Daily'] = {'columns': ['Station', 'Time', 'TX'], 'last_time': {}}
+        # The file now has another variable, the CSV is rebuilt from the next file only
+        chunk = pd.DataFrame({'Station': ['260'], 'Time': pd.to_datetime(['2024-05-01']), 'TG': [1.0], 'TX': [2.0]})
+        write_outputs([chunk], ['csv'], 'account', 'key', 'container', 'KNMI_Data_Daily.csv', 'KNMI_Data_Daily',
+                      manifest=manifest, incremental=True)
+        self.assertFalse(is_ingested(manifest, FILE_INFO, selection_key(None, None), ['csv:KNMI_Data_Daily']))
+
+
+class FakeContainer:
+    """Container client that keeps the blobs in memory."""
+
+    def __init__(self):
+        self.blobs = {}
+
+    def list_blobs(self, name_starts_with=''):
+        return [SimpleNamespace(name=name) for name in sorted(self.blobs) if name.startswith(name_starts_with)]
+
+    def upload_blob(self, name, data, overwrite=False):
+        self.blobs[name] = data
+
+    def download_blob(self, name):
+        return SimpleNamespace(readall=lambda: self.blobs[name])
+
+    def delete_many(self, account_name, account_key, container_name, names):
+        for name in names:
+            del self.blobs[name]
+
+
+class TestParquetStore(unittest.TestCase):
+
+    def setUp(self):
+        self.container = FakeContainer()
+        patchers = [patch('Download_KNMI_Report.get_container_client', return_value=self.container),
+                    patch('Download_KNMI_Report.delete_many_in_dls', side_effect=self.container.delete_many)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def store(self, stations, day, **kwargs):
+        df = pd.DataFrame({'Station': stations, 'Time': pd.to_datetime([day] * len(stations)), 'TG': [1.0] * len(stations)})
+        return store_parquet_in_dls(df, 'account', 'key', 'container', 'daily', part_name=f'part-{day}', **kwargs)
+
+    def test_rebuild_only_replaces_the_written_stations(self):
+        self.store(['240', '260'], '2024-05-01')
+        self.store(['260'], '2024-05-02', replace_stations=['260'])
+        self.assertEqual(sorted(self.container.blobs), ['daily/Station=240/Year=2024/part-2024-05-01.parquet',
+                                                        'daily/Station=260/Year=2024/part-2024-05-02.parquet'])
+
+    def test_compaction_merges_the_parts_of_full_partitions(self):
+        for day in ('2024-05-01', '2024-05-02', '2024-05-03'):
+            self.assertEqual(self.store(['260'], day), ['daily/Station=260/Year=2024'])
+        self.store(['240'], '2024-05-01')
+
+        compacted = compact_parquet('account', 'key', 'container', 'daily', min_parts=3)
+
+        self.assertEqual(compacted, ['daily/Station=260/Year=2024'])
+        names = sorted(self.container.blobs)
+        self.assertEqual(len(names), 2)
+        self.assertEqual(names[0], 'daily/Station=240/Year=2024/part-2024-05-01.parquet')
+        df = pd.read_parquet(BytesIO(self.container.blobs[names[1]]))
+        self.assertEqual(df['Time'].dt.strftime('%Y-%m-%d').tolist(), ['2024-05-01', '2024-05-02', '2024-05-03'])
+
+
+class TestSelectNewDays(unittest.TestCase):
+
+    def test_keeps_days_after_the_last_day_of_each_station(self):
+        df = pd.DataFrame({
+            'Station': ['260', '260', '344', '344', '380'],
+            'Time': pd.to_datetime(['2024-05-01', '2024-05-02', '2024-05-01', '2024-05-02', '2024-05-01']),
+        })
+        new = select_new_days(df, {'260': '2024-05-01', '344': '2024-05-02'})
+        self.assertEqual(list(zip(new['Station'], new['Time'].dt.strftime('%Y-%m-%d'))),
+                         [('260', '2024-05-02'), ('380', '2024-05-01')])
+
+    def test_without_last_days_keeps_everything(self):
+        df = pd.DataFrame({'Station': ['260'], 'Time': pd.to_datetime(['2024-05-01'])})
+        self.assertEqual(len(select_new_days(df, {})), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
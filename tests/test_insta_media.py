@@ -0,0 +1,50 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+from Insta_media import HOT_DAYS, merge_posts, sync_cutoff
+
+
+class TestSyncCutoff(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime(2024, 6, 30, 12, 0, tzinfo=timezone.utc)
+
+    def test_first_run_lists_everything(self):
+        self.assertIsNone(sync_cutoff({'last_timestamp': None, 'post_ids': []}, self.now))
+
+    def test_recent_watermark_refreshes_the_hot_window(self):
+        state = {'last_timestamp': '2024-06-29T08:00:00+0000', 'post_ids': ['1']}
+        self.assertEqual(sync_cutoff(state, self.now), self.now - timedelta(days=HOT_DAYS))
+
+    def test_old_watermark_lists_back_to_it(self):
+        last_timestamp = self.now - timedelta(days=HOT_DAYS + 10)
+        state = {'last_timestamp': last_timestamp.strftime('%Y-%m-%dT%H:%M:%S%z'), 'post_ids': ['1']}
+        self.assertEqual(sync_cutoff(state, self.now), last_timestamp)
+
+
+class TestMergePosts(unittest.TestCase):
+
+    def test_without_stored_posts(self):
+        fetched = pd.DataFrame({'id': ['1'], 'timestamp': ['2024-06-01T10:00:00+0000'], 'like_count': [5]})
+        self.assertIs(merge_posts(None, fetched), fetched)
+
+    def test_fetched_posts_replace_stored_rows(self):
+        existing = pd.DataFrame({
+            'id': ['2', '1'],
+            'timestamp': ['2024-06-02T10:00:00+0000', '2024-05-01T10:00:00+0000'],
+            'like_count': [3, 7],
+        })
+        fetched = pd.DataFrame({
+            'id': ['3', '2'],
+            'timestamp': ['2024-06-03T10:00:00+0000', '2024-06-02T10:00:00+0000'],
+            'like_count': [1, 9],
+        })
+        merged = merge_posts(existing, fetched)
+        self.assertEqual(merged['id'].tolist(), ['3', '2', '1'])
+        self.assertEqual(merged['like_count'].tolist(), [1, 9, 7])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import unittest
+from io import BytesIO
+
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+
+from knmi import PARTITION_DEFAULT, iter_normalized_chunks, normalize_dataset, normalize_window, parquet_partitions, \
+    select, window_size
+
+FILL_VALUE = -9999.0
+
+
+def build_dataset(days=4):
+    """Diskless daily station file with three stations and two variables, shaped like the KNMI file."""
+    dataset = nc.Dataset('test.nc', 'w', diskless=True, persist=False)
+    dataset.createDimension('station', 3)
+    dataset.createDimension('time', days)
+
+    station = dataset.createVariable('station', str, ('station',))
+    for i, code in enumerate(['06240', '06260', '06344']):
+        station[i] = code
+
+    # Daily values are stamped at the end of their day
+    time_var = dataset.createVariable('time', 'f8', ('time',))
+    time_var.units = 'seconds since 1950-01-01 00:00:00'
+    time_var[:] = (np.arange(days) + 1) * 86400.0
+
+    for name, long_name, offset in [('TG', 'Daily mean temperature', 0), ('TX', 'Maximum temperature', 100)]:
+        var = dataset.createVariable(name, 'f4', ('station', 'time'), fill_value=FILL_VALUE)
+        var.long_name = long_name
+        values = (offset + 10 * np.arange(3)[:, None] + np.arange(days)[None, :]).astype('f4')
+        var[:] = values
+    # One missing observation of 344
+    dataset.variables['TG'][2, 1] = np.ma.masked
+    return dataset
+
+
+class TestSelect(unittest.TestCase):
+
+    def setUp(self):
+        self.dataset = build_dataset()
+        self.addCleanup(self.dataset.close)
+
+    def test_defaults_to_de_bilt_and_every_variable(self):
+        self.assertEqual(select(self.dataset), ([1], ['260'], ['TG', 'TX']))
+
+    def test_wmo_and_knmi_codes_in_file_order(self):
+        positions, codes, variables = select(self.dataset, ['344', '06240', '240'], ['TX'])
+        self.assertEqual(positions, [0, 2])
+        self.assertEqual(codes, ['240', '344'])
+        self.assertEqual(variables, ['TX'])
+
+    def test_unknown_station(self):
+        with self.assertRaisesRegex(KeyError, '999'):
+            select(self.dataset, ['260', '999'])
+
+    def test_unknown_variable(self):
+        with self.assertRaisesRegex(KeyError, 'RH'):
+            select(self.dataset, None, ['TG', 'RH'])
+
+
+class TestNormalize(unittest.TestCase):
+
+    def setUp(self):
+        self.dataset = build_dataset()
+        self.addCleanup(self.dataset.close)
+
+    def test_rows_per_station_then_time(self):
+        df = normalize_window(self.dataset, [0, 2], ['240', '344'], ['TG', 'TX'], 1, 3)
+        self.assertEqual(list(df.columns), ['Station', 'Time', 'Daily mean temperature', 'Maximum temperature'])
+        self.assertEqual(list(df['Station']), ['240', '240', '344', '344'])
+        self.assertEqual(list(df['Time'].dt.strftime('%Y-%m-%d')), ['1950-01-02', '1950-01-03'] * 2)
+        self.assertEqual(list(df['Maximum temperature']), [101.0, 102.0, 121.0, 122.0])
+
+    def test_masked_values_become_nan(self):
+        df = normalize_window(self.dataset, [2], ['344'], ['TG'], 0, 3)
+        values = df['Daily mean temperature']
+        self.assertEqual(values.isna().tolist(), [False, True, False])
+        self.assertNotIn(FILL_VALUE, values.tolist())
+
+    def test_time_is_not_shifted_for_other_datasets(self):
+        df = normalize_window(self.dataset, [1], ['260'], ['TG'], 0, 1, daily=False)
+        self.assertEqual(df['Time'].iloc[0], pd.Timestamp('1950-01-02'))
+
+
+class TestWindows(unittest.TestCase):
+
+    def test_window_size(self):
+        # Two stations with three variables take 2 * (3 + 2) * 32 bytes per time step
+        self.assertEqual(window_size(2, 3, memory_budget=1000), 3)
+        self.assertEqual(window_size(2, 3, memory_budget=10), 1)
+
+    def test_chunks_add_up_to_the_whole_file(self):
+        dataset = build_dataset(days=7)
+        self.addCleanup(dataset.close)
+        # Three time steps of one station and two variables per window
+        chunks = list(iter_normalized_chunks(dataset, ['260'], None, memory_budget=3 * 4 * 32))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), normalize_dataset(dataset, ['260']))
+
+    def test_selection_is_validated_before_the_first_window(self):
+        dataset = build_dataset()
+        self.addCleanup(dataset.close)
+        with self.assertRaises(KeyError):
+            iter_normalized_chunks(dataset, ['999'])
+
+
+class TestParquetPartitions(unittest.TestCase):
+
+    def test_paths_per_station_and_year(self):
+        df = pd.DataFrame({
+            'Station': ['260', '260', '240', '260'],
+            'Time': pd.to_datetime(['2023-12-31', '2024-01-01', '2024-01-01', None]),
+            'TG': [1.0, 2.0, 3.0, 4.0],
+        })
+        paths = [path for path, _ in parquet_partitions(df, 'part-1')]
+        self.assertEqual(paths, ['Station=240/Year=2024/part-1.parquet', 'Station=260/Year=2023/part-1.parquet',
+                                 'Station=260/Year=2024/part-1.parquet',
+                                 f'Station=260/Year={PARTITION_DEFAULT}/part-1.parquet'])
+
+    def test_partition_columns_are_left_out_of_the_files(self):
+        df = pd.DataFrame({'Station': ['260'], 'Time': pd.to_datetime(['2024-05-01 10:00']), 'TG': [1.0]})
+        [(_, data)] = list(parquet_partitions(df, 'part-1'))
+        self.assertEqual(list(pd.read_parquet(BytesIO(data)).columns), ['Time', 'TG'])
+
+    def test_date_partitions(self):
+        df = pd.DataFrame({'Station': ['260'], 'Time': pd.to_datetime(['2024-05-01 10:00']), 'TG': [1.0]})
+        [(path, data)] = list(parquet_partitions(df, 'part-1', partition_by=('Date',)))
+        self.assertEqual(path, 'Date=2024-05-01/part-1.parquet')
+        self.assertEqual(list(pd.read_parquet(BytesIO(data)).columns), ['Station', 'Time', 'TG'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import json
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+import meta_graph
+from meta_graph import MAX_CALL_SPACING, RateBudget, RateBudgetExceeded, UsageGovernor
+
+
+class TestUsageGovernor(unittest.TestCase):
+
+    def test_limits_below_half_the_target(self):
+        governor = UsageGovernor('test', target=80, max_concurrency=8)
+        governor.utilization = 39
+        self.assertEqual(governor.limits(), (8, 0.0))
+
+    def test_limits_scale_down_towards_the_target(self):
+        governor = UsageGovernor('test', target=80, max_concurrency=8)
+        governor.utilization = 60
+        self.assertEqual(governor.limits(), (4, MAX_CALL_SPACING * 0.5))
+        governor.utilization = 80
+        self.assertEqual(governor.limits(), (1, MAX_CALL_SPACING))
+
+    def test_update_below_the_target_does_not_pause(self):
+        governor = UsageGovernor('test', target=80)
+        governor.update(50)
+        self.assertEqual(governor.paused_until, 0.0)
+        governor.acquire(max_wait=0)
+        governor.release()
+
+    def test_update_at_the_target_pauses_for_the_regain_time(self):
+        governor = UsageGovernor('test', target=80)
+        governor.update(85, regain_seconds=600)
+        self.assertGreater(governor.paused_until, time.monotonic() + 590)
+        with self.assertRaises(RateBudgetExceeded):
+            governor.acquire(max_wait=1)
+
+    def test_update_at_the_target_pauses_at_least_the_cooldown(self):
+        governor = UsageGovernor('test', target=80)
+        with patch.object(meta_graph, 'COOLDOWN', 120):
+            governor.update(80)
+        self.assertGreater(governor.paused_until, time.monotonic() + 110)
+
+    def test_acquire_waits_for_a_free_slot(self):
+        governor = UsageGovernor('test', max_concurrency=1)
+        governor.acquire(max_wait=0)
+        with self.assertRaises(RateBudgetExceeded):
+            governor.acquire(max_wait=0.1)
+        governor.release()
+        governor.acquire(max_wait=0)
+        self.assertEqual(governor.active, 1)
+
+
+class TestParseUsage(unittest.TestCase):
+
+    def test_both_headers(self):
+        headers = {
+            'X-App-Usage': json.dumps({'call_count': 12, 'total_cputime': 30, 'total_time': 25}),
+            'X-Business-Use-Case-Usage': json.dumps({
+                '17841400000000000': [
+                    {'type': 'instagram', 'call_count': 40, 'total_cputime': 10, 'total_time': 55,
+                     'estimated_time_to_regain_access': 0},
+                    {'type': 'pages', 'call_count': 95, 'total_cputime': 5, 'total_time': 5,
+                     'estimated_time_to_regain_access': 3},
+                ],
+            }),
+        }
+        self.assertEqual(meta_graph.parse_usage(headers), (30, 95, 180))
+
+    def test_without_headers(self):
+        self.assertEqual(meta_graph.parse_usage({}), (0, 0, 0))
+
+
+class TestIsThrottled(unittest.TestCase):
+
+    def test_status_429(self):
+        self.assertTrue(meta_graph.is_throttled(Mock(status_code=429)))
+
+    def test_rate_limit_error_code(self):
+        response = Mock(status_code=400, json=Mock(return_value={'error': {'code': 80002}}))
+        self.assertTrue(meta_graph.is_throttled(response))
+
+    def test_other_error(self):
+        response = Mock(status_code=400, json=Mock(return_value={'error': {'code': 100}}))
+        self.assertFalse(meta_graph.is_throttled(response))
+
+    def test_body_without_json(self):
+        response = Mock(status_code=500, json=Mock(side_effect=ValueError))
+        self.assertFalse(meta_graph.is_throttled(response))
+
+    def test_quota_of_the_error_code(self):
+        app = Mock(status_code=400, json=Mock(return_value={'error': {'code': 4}}))
+        account = Mock(status_code=400, json=Mock(return_value={'error': {'code': 80002}}))
+        plain_429 = Mock(status_code=429, json=Mock(side_effect=ValueError))
+        self.assertEqual(meta_graph.throttled_quota(app), 'app')
+        self.assertEqual(meta_graph.throttled_quota(account), 'account')
+        self.assertEqual(meta_graph.throttled_quota(plain_429), 'account')
+
+
+@patch.object(meta_graph, 'THROTTLE_RETRIES', 0)
+class TestRequest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(meta_graph, '_app_governor', UsageGovernor('the app'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, body, account_id):
+        response = Mock(status_code=400, headers={}, from_cache=False, json=Mock(return_value=body))
+        with patch('http_client.request', side_effect=[None, response]) as request:
+            meta_graph.request('GET', 'https://graph.facebook.com/v20.0/me', RateBudget(account_id))
+        return request
+
+    def test_account_throttle_only_pauses_the_account(self):
+        request = self.send({'error': {'code': 80002}}, 'throttled-account')
+        self.assertGreater(meta_graph.account_governor('throttled-account').paused_until, time.monotonic())
+        self.assertEqual(meta_graph._app_governor.paused_until, 0.0)
+        self.assertNotIn(429, request.call_args.kwargs['retry_statuses'])
+
+    def test_app_throttle_only_pauses_the_app(self):
+        self.send({'error': {'code': 4}}, 'app-throttled-account')
+        self.assertGreater(meta_graph._app_governor.paused_until, time.monotonic())
+        self.assertEqual(meta_graph.account_governor('app-throttled-account').paused_until, 0.0)
+
+
+class TestRateBudget(unittest.TestCase):
+
+    def test_acquire_takes_calls_from_the_budget(self):
+        budget = RateBudget('test', calls_per_hour=10)
+        budget.acquire(calls=4)
+        self.assertLessEqual(budget.tokens, 6.01)
+
+    def test_used_up_budget_raises_past_the_max_wait(self):
+        budget = RateBudget('test', calls_per_hour=10, max_wait=1)
+        budget.acquire(calls=10)
+        with self.assertRaises(RateBudgetExceeded):
+            budget.acquire()
+
+
+class TestForEachAccount(unittest.TestCase):
+
+    def test_failed_accounts_are_skipped(self):
+        def work(account_id, token_secret_name):
+            if account_id == '2':
+                raise RateBudgetExceeded('used up')
+            if account_id == '3':
+                raise meta_graph.GraphAPIError({'code': 190, 'message': 'Error validating access token'})
+            return account_id
+
+        accounts = [('1', 'secret'), ('2', 'secret'), ('3', 'secret')]
+        results, skipped = meta_graph.for_each_account(accounts, work)
+        self.assertEqual(results, ['1', None, None])
+        self.assertEqual(list(skipped), ['2', '3'])
+
+        message, status_code = meta_graph.accounts_summary(accounts, skipped, 'Stored')
+        self.assertEqual(status_code, 207)
+        self.assertIn('for 1 accounts', message)
+        self.assertIn('3: Graph API error 190', message)
+
+    def test_summary_when_every_account_was_skipped(self):
+        accounts = [('1', 'secret'), ('2', 'secret')]
+        budget = {'1': RateBudgetExceeded('used up'), '2': RateBudgetExceeded('used up')}
+        self.assertEqual(meta_graph.accounts_summary(accounts, budget, 'Stored')[1], 429)
+        failed = dict(budget, **{'2': ConnectionError('reset')})
+        self.assertEqual(meta_graph.accounts_summary(accounts, failed, 'Stored')[1], 500)
+        self.assertEqual(meta_graph.accounts_summary(accounts, {}, 'Stored'), ('Stored for 2 accounts', 200))
+
+
+if __name__ == '__main__':
+    unittest.main()